@@ -7,21 +7,16 @@ if sys.version_info.major is not 3 and sys.version_info.minor < 5:
     sys.exit("Please use Python 3.5 or higher")
 
 
+import os
 import csv
 import json
 import argparse
 from itertools import chain, islice
 from collections import Counter, defaultdict
 
-try:
-    import regex
-except ImportError as error:
-    sys.exit("Please install " + error.name)
-
-
 try:
     # from parallel import parallelize
-    from partition import IUPAC_CODES
+    from partition import IUPAC_CODES, expand_iupac, unpack, apply_layouts
 except ImportError:
     sys.exit("Please leave this program in its directory to load custom modules")
 
@@ -29,10 +24,24 @@ except ImportError:
 class InputError(Exception):
     '''An error occurred because of your input'''
     def __init__(self, message):
-        super().__init__(self)
+        super().__init__(message)
         self.message = message
 
 
+def memory_size(value):
+    '''
+    Reads a memory size such as 512M or 8G, or a number of bytes, for the command line
+    '''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = value.strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("cannot read memory size '%s', try 512M or 8G" % value)
+
+
 #   A function to create an argument parser
 def _set_args():
     parser = argparse.ArgumentParser( # type: argparse.ArgumentParser
@@ -49,15 +58,24 @@ def _set_args():
         formatter_class=argparse.RawTextHelpFormatter,
         add_help=True
     )
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group(required=True) # type: argparse._MutuallyExclusiveGroup
+    inputs.add_argument(
         '-f',
         '--forward-fastq',
         dest='forward',
         type=str,
         default=None,
         metavar='FORWARD FASTQ',
-        help="Provide a filepath for the Forward FASTQ file.\n[REQUIRED]",
-        required=True
+        help="Provide a filepath for the Forward FASTQ file,\n'-' for standard input, or a named pipe.\n[REQUIRED, or -F]"
+    )
+    inputs.add_argument(
+        '-F',
+        '--fastq-manifest',
+        dest='lanes',
+        type=str,
+        default=None,
+        metavar='FASTQ MANIFEST',
+        help="Provide a filepath for a tab-separated list of lanes, \nthe Forward and optional Reverse FASTQ file of one \nlane per line, to partition together instead of -f \nand -r. Each sample's output is merged across lanes \nand named after the manifest.\n[REQUIRED, or -f]"
     )
     parser.add_argument(
         '-r',
@@ -66,7 +84,16 @@ def _set_args():
         type=str,
         default=None,
         metavar='REVERSE FASTQ',
-        help="Provide a filepath for the Reverse FASTQ file.\n[OPTIONAL]"
+        help="Provide a filepath for the Reverse FASTQ file,\n'-' for standard input, or a named pipe.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-d',
+        '--output-directory',
+        dest='output',
+        type=str,
+        default=None,
+        metavar='OUTPUT DIRECTORY',
+        help="Where to write the output.\n[OPTIONAL, DEFAULT=the forward FASTQ's directory,\nthe manifest's directory for -F,\nor the working directory for standard input]"
     )
     parser.add_argument(
         '-s',
@@ -97,57 +124,252 @@ def _set_args():
         metavar='ERROR',
         help="This is how many mismatches in the barcode \nwe allowed before rejecting.\n[OPTIONAL, DEFAULT=1]"
     )
+    parser.add_argument(
+        '-o',
+        '--offset',
+        dest='offset',
+        type=int,
+        default=None,
+        metavar='OFFSET',
+        help="Position of fixed-length barcodes in the reads, \nlooked up in a precomputed table instead of searched for. \nCannot be given with read layouts.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-m',
+        '--matcher',
+        dest='matcher',
+        type=str,
+        default='index',
+        choices=('index', 'matrix'),
+        metavar='MATCHER',
+        help="How to match barcodes at -o: 'index' looks up every \nvariant in a table, 'matrix' computes distances to \nevery barcode for batches of reads with NumPy.\n[OPTIONAL, DEFAULT=index]"
+    )
+    parser.add_argument(
+        '-y',
+        '--layout',
+        dest='layout',
+        type=str,
+        default=None,
+        metavar='LAYOUT',
+        help="Read layout for every sample, such as 6B8U4S+T: lengths of \nbarcode (B), UMI (U), spacer (S), and template (T),\n'+' runs to the end of the read. Separate forward and \nreverse layouts with a ','. Only the barcode window \nis searched. A 'layout' column in the sample sheet \nsets layouts per sample. Cannot be given with -o.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-w',
+        '--shift',
+        dest='shift',
+        type=int,
+        default=0,
+        metavar='SHIFT',
+        help="How many bases barcodes may be shifted from their \nplace in the read layout.\n[OPTIONAL, DEFAULT=0]"
+    )
+    parser.add_argument(
+        '-i',
+        '--dual-index',
+        dest='dual_index',
+        action='store_true',
+        help="Find the forward (i7) and reverse (i5) barcodes of \ndual-indexed samples on their own and look the pair \nup, so barcodes may be shared between samples. \nPairs that match no sample are counted as index hops \nin the report. Needs -r and two barcodes per sample.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-U',
+        '--extract-umis',
+        dest='extract_umis',
+        action='store_true',
+        help="Move UMIs, the 'N's of the barcodes and the 'U's \nof the layout, from the reads into their read IDs, \nas READ_UMI like UMI-tools extract, and report \nduplication statistics for each sample.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-z',
+        '--compress',
+        dest='compress',
+        type=str,
+        default=None,
+        choices=('gzip', 'bgzf'),
+        metavar='COMPRESS',
+        help="Compress the output FASTQ files with 'gzip' or 'bgzf'.\nGzipped and BGZF input is always read directly.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=None,
+        metavar='THREADS',
+        help="Number of worker processes to partition with.\n[OPTIONAL, DEFAULT=all cores]"
+    )
+    parser.add_argument(
+        '-S',
+        '--scheduler',
+        dest='scheduler',
+        type=str,
+        default=None,
+        metavar='ADDRESS',
+        help="Partition chunks on the dask.distributed cluster at \nADDRESS, such as tcp://10.0.0.1:8786, instead of \nlocal processes; 'local' starts a cluster of -t \nworkers on this machine. Inputs and output must be \non a filesystem shared by every node.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-p',
+        '--profile',
+        dest='profile',
+        action='store_true',
+        help="Profile the manager and every worker with cProfile, \nmerged into profile.prof and profile.txt.\n[OPTIONAL]"
+    )
+    parser.add_argument(
+        '-R',
+        '--resume',
+        dest='resume',
+        action='store_true',
+        help="Resume a stopped run from its manifest, only partitioning \nthe chunks it had not finished.\n[OPTIONAL]"
+    )
     parser.add_argument(
         '-l',
         '--numlines',
         dest='numlines',
         type=int,
-        default=40000,
+        default=None,
         metavar='NUMLINES',
-        help='We internally split your input file(s) into \nmany smaller files, after -l lines.\n[OPTIONAL, DEFAULT=40000]'
+        help='We internally split your input file(s) into \nchunks of about -l lines.\n[OPTIONAL, DEFAULT=sized from the input, workers, and -M]'
+    )
+    parser.add_argument(
+        '-M',
+        '--max-memory',
+        dest='max_memory',
+        type=memory_size,
+        default=None,
+        metavar='MEMORY',
+        help='Memory for the workers to share, such as 8G or 512M; \nbounds their output buffers and streamed batches.\n[OPTIONAL, DEFAULT=half of the physical memory]'
     )
     
     return parser
 
 
-def expand_iupac(barcode):
+def barcode_check(barcode_dict, dual_index=False):
     '''
-    Expand IUPAC codes, i.e. turn 'AY' to ['AC', 'AT'], removes 'N's
+    Checks whether or not there are barcodes in use that are ambiguous and could thus recognize the same sequence.
+    For example the barcodes 'AY' and 'AW' both recognize 'AT'.
+    Does not check for ambiguity with regards to UMIs, i.e. strings of 'N'. So 'ACGN' and 'ACGT' are recognized as different
+    even though they can both match 'ACGT'.
+    With 'dual_index' the forward and reverse barcodes are checked separately, a barcode can be shared by
+    several samples, and only samples with the same pair of barcodes are ambiguous.
     '''
-    barcode = barcode.upper()
-    if all((i in 'ACGTN' for i in set(barcode))):
-        return barcode.replace('N','')
+    if dual_index:
+        groups = [set(barcodes[index] for barcodes in barcode_dict.values()) for index in (0, 1)]
     else:
-        pos = regex.search(r'[%s]' % ''.join(IUPAC_CODES.keys()), barcode).start()
-        code = barcode[pos]
-        return (expand_iupac(barcode.replace(code, i, 1)) for i in IUPAC_CODES[code])
+        groups = [chain.from_iterable(barcode_dict.values())]
+    multiplicate_barcodes = dict()
+    for barcodes in groups:
+        expanded_barcodes = unpack(expand_iupac(bc) for bc in barcodes)
+        multiplicate_barcodes.update(filter(lambda item: item[1] > 1 , Counter(expanded_barcodes).items()))
+    if dual_index:
+        pairs = Counter('+'.join(barcodes) for barcodes in barcode_dict.values())
+        multiplicate_barcodes.update(filter(lambda item: item[1] > 1 , pairs.items()))
+    return multiplicate_barcodes
 
 
-def unpack(collection):
+def _encode_barcodes(barcodes, length, np):
     '''
-    Unpack a series of nested lists, sets, or tuples
+    Encode barcodes as a matrix of base masks (A=1, C=2, G=4, T=8), where IUPAC codes
+    combine the masks of their bases and 'N's, missing barcodes, and padding match anything
     '''
-    result = [] # type: List
-    for item in collection:
-        # if isinstance(item, (list, set, tuple)):
-        if hasattr(item, '__iter__') and not isinstance(item, str):
-            result.extend(unpack(collection=item))
-        else:
-            result.append(item)
-    return result
+    masks = dict(zip('ACGT', (1, 2, 4, 8)))
+    for code, bases in IUPAC_CODES.items():
+        masks[code] = sum(masks[base] for base in bases)
+    table = np.full(256, 15, dtype=np.uint8)
+    for base, mask in masks.items():
+        table[ord(base)] = table[ord(base.lower())] = mask
+    encoded = np.full((len(barcodes), length), 15, dtype=np.uint8)
+    for row, barcode in enumerate(barcodes):
+        if barcode:
+            encoded[row, :len(barcode)] = table[np.frombuffer(barcode.encode(), dtype=np.uint8)]
+    return encoded
 
 
-def barcode_check(barcode_dict):
+def _match_matrices(encoded, np):
     '''
-    Checks whether or not there are barcodes in use that are ambiguous and could thus recognize the same sequence.
-    For example the barcodes 'AY' and 'AW' both recognize 'AT'.
-    Does not check for ambiguity with regards to UMIs, i.e. strings of 'N'. So 'ACGN' and 'ACGT' are recognized as different
-    even though they can both match 'ACGT'.
+    One-hot matrix of the base masks in an encoded barcode matrix, and the matrix of the masks each
+    barcode can match at each position; their product counts the positions where two barcodes can match
     '''
-    barcodes = chain.from_iterable(barcode_dict.values())
-    expanded_barcodes = unpack(expand_iupac(bc) for bc in barcodes)
-    multiplicate_barcodes = dict(filter(lambda item: item[1] > 1 , Counter(expanded_barcodes).items()))
-    return multiplicate_barcodes
+    masks = np.unique(encoded)
+    onehot = encoded[:, :, None] == masks[None, None, :]
+    matches = (encoded[:, :, None] & masks[None, None, :]) != 0
+    return tuple(matrix.reshape(encoded.shape[0], -1).astype(np.float32) for matrix in (onehot, matches))
+
+
+def _distances(encoded, matrices, start, stop, np):
+    '''
+    Count the positions where rows 'start' to 'stop' of an encoded barcode matrix cannot match every row
+    '''
+    onehot, matches = matrices
+    return encoded.shape[1] - onehot[start:stop] @ matches.T
+
+
+def _close_barcodes(forward, reverse, radius, block_size, np):
+    '''
+    Yield the (row, row, forward distance, reverse distance) pairs of barcodes within 'radius' of each other,
+    where rows without a reverse barcode only need close forward barcodes
+    '''
+    encoded_forward = _encode_barcodes(forward, max(map(len, forward), default=0), np)
+    encoded_reverse = _encode_barcodes(reverse, max((len(barcode) for barcode in reverse if barcode), default=0), np)
+    matrices_forward = _match_matrices(encoded_forward, np)
+    matrices_reverse = _match_matrices(encoded_reverse, np)
+    has_reverse = np.array([barcode is not None for barcode in reverse])
+    for start in range(0, len(forward), block_size):
+        stop = min(start + block_size, len(forward))
+        forward_distance = _distances(encoded_forward, matrices_forward, start, stop, np)
+        reverse_distance = _distances(encoded_reverse, matrices_reverse, start, stop, np)
+        both_reverse = has_reverse[start:stop, None] & has_reverse[None, :]
+        close = (forward_distance <= radius) & (~both_reverse | (reverse_distance <= radius))
+        close &= np.arange(len(forward))[None, :] > np.arange(start, stop)[:, None]
+        for row, column in zip(*np.nonzero(close)):
+            yield (
+                start + row,
+                int(column),
+                int(forward_distance[row, column]),
+                int(reverse_distance[row, column]) if both_reverse[row, column] else None
+            )
+
+
+def barcode_distance_check(barcode_dict, error_rate, dual_index=False, block_size=1024):
+    '''
+    Checks whether any two samples have barcodes close enough that, with 'error_rate' errors
+    allowed per barcode, they could both match the same read: two barcodes at distance
+    'd' can claim the same read when d <= 2 * error_rate. Samples with two barcodes only
+    conflict if both their forward and their reverse barcodes are that close.
+    With 'dual_index' each index is matched on its own, so the distinct forward barcodes and the
+    distinct reverse barcodes are checked separately, and samples may share a barcode.
+    The distance between IUPAC codes is the smallest distance between their expansions,
+    'N's match anything, and shorter barcodes are compared with the start of longer ones.
+    Distances are computed with NumPy, a block of samples against every sample at a time.
+    Returns a list of (sample, sample, forward distance, reverse distance) conflicts,
+    or (barcode, barcode, forward distance, None) and (barcode, barcode, None, reverse distance) with 'dual_index'.
+    '''
+    try:
+        import numpy as np
+    except ImportError as error:
+        sys.exit("Please install " + error.name)
+    radius = 2 * (error_rate or 0)
+    if dual_index:
+        conflicts = []
+        for index in (0, 1):
+            barcodes = sorted(set(barcodes[index] for barcodes in barcode_dict.values()))
+            for row, column, distance, _ in _close_barcodes(barcodes, [None] * len(barcodes), radius, block_size, np):
+                distances = (distance, None) if index == 0 else (None, distance)
+                conflicts.append((barcodes[row], barcodes[column]) + distances)
+        return conflicts
+    samples = list(barcode_dict.keys())
+    barcode_lists = [list(filter(None, barcode_dict[sample])) for sample in samples]
+    forward = [barcodes[0] for barcodes in barcode_lists]
+    reverse = [barcodes[1] if len(barcodes) > 1 else None for barcodes in barcode_lists]
+    return [
+        (samples[row], samples[column], forward_distance, reverse_distance)
+        for row, column, forward_distance, reverse_distance in _close_barcodes(forward, reverse, radius, block_size, np)
+    ]
+
+
+def supported_error_rate(barcode_conflicts):
+    '''
+    Returns the largest error rate at which none of the conflicts from barcode_distance_check remain,
+    or -1 if even -e 0 cannot tell a pair apart. A pair of samples stops conflicting once its closer
+    barcode is more than 2 * error_rate away.
+    '''
+    distance = min(max(d for d in conflict[2:] if d is not None) for conflict in barcode_conflicts)
+    return (distance - 1) // 2
 
 
 def extract_barcodes(sample_sheet, barcode_csv):
@@ -174,19 +396,105 @@ def extract_barcodes(sample_sheet, barcode_csv):
 
 
 
+def extract_layouts(sample_sheet, default=None):
+    '''
+    Returns a dictionary, Keys are the sample_names, values are the read layouts from the
+    optional fourth 'layout' column of the sample sheet, or the default layout.
+    '''
+    with open(sample_sheet) as ss_reader:
+        layouts = dict()
+        for line in islice(csv.reader(ss_reader, delimiter='\t'), 1, None):
+            if len(line) < 3:
+                continue
+            layout = line[3].strip() if len(line) > 3 else ''
+            if layout or default:
+                layouts[line[2]] = layout or default
+        return layouts
+
+
+def extract_lanes(fastq_manifest):
+    '''
+    Returns a list of (forward, reverse) FASTQ filenames, one for each line of the tab-separated
+    manifest, where reverse is None for single-end lanes. Relative filenames are read from the
+    manifest's directory, '-' is standard input, and blank lines and lines starting with '#' are skipped.
+    '''
+    directory = os.path.dirname(os.path.abspath(fastq_manifest))
+    with open(fastq_manifest) as manifest_reader:
+        lanes = list()
+        for line in csv.reader(manifest_reader, delimiter='\t'):
+            line = [field.strip() for field in line if field.strip()]
+            if not line or line[0].startswith('#'):
+                continue
+            if len(line) > 2:
+                raise InputError('Each line of the FASTQ manifest needs a forward and at most one reverse FASTQ file')
+            lanes.append(tuple(fastq if fastq == '-' else os.path.join(directory, fastq) for fastq in line) + (None,) * (2 - len(line)))
+        if not lanes:
+            raise InputError('The FASTQ manifest ' + fastq_manifest + ' has no lanes')
+        if len(set(reverse is None for forward, reverse in lanes)) > 1:
+            raise InputError('Either every lane in the FASTQ manifest or none needs a reverse FASTQ file')
+        return lanes
+
+
 def main(args):
     from parallel import parallelize
     '''Run the program'''
-    if args['numlines']%4 != 0:
+    if args['numlines'] and args['numlines']%4 != 0:
         raise InputError('-l  must be divisible by four'+str(args['numlines']))
+    lanes = None
+    output_name = None
+    if args['lanes']:
+        if args['reverse']:
+            raise InputError('-r cannot be given with -F, the reverse FASTQ files go in the manifest')
+        lanes = extract_lanes(args['lanes'])
+        args['reverse'] = lanes[0][1]
+        args['output'] = args['output'] or os.path.dirname(os.path.abspath(args['lanes']))
+        output_name = os.path.splitext(os.path.basename(args['lanes']))[0] + '.fastq'
     sample_dict = extract_barcodes(args['sample'],args['barcodes'])
-    barcode_ambiguity_dict = barcode_check(sample_dict)
+    if args['dual_index'] and (not args['reverse'] or any(len(barcodes) != 2 for barcodes in sample_dict.values())):
+        raise InputError('-i needs a reverse FASTQ file (-r) and two barcodes for every sample')
+    barcode_ambiguity_dict = barcode_check(sample_dict, args['dual_index'])
     if barcode_ambiguity_dict:
         raise InputError("There are ambiguous barcodes \n" + str(json.dumps(barcode_ambiguity_dict, indent=2)))
+    barcode_conflicts = barcode_distance_check(sample_dict, args['error'], args['dual_index'])
+    if barcode_conflicts:
+        supported = supported_error_rate(barcode_conflicts)
+        raise InputError(
+            "There are barcodes within twice the error rate (-e %i) of each other, " % args['error']
+            + ("these barcodes support -e %i at most \n" % supported if supported >= 0 else "no error rate can tell them apart \n")
+            + str(json.dumps(barcode_conflicts[:100], indent=2))
+        )
+    layouts = extract_layouts(args['sample'], args['layout'])
+    if layouts and args['offset'] is not None:
+        raise InputError('-o cannot be given with read layouts (-y or the layout column of the sample sheet), the layouts already place the barcodes in the reads')
+    try:
+        apply_layouts(sample_dict, layouts)
+    except ValueError as error:
+        raise InputError(str(error))
     #call the parallel layer which does the work:
     '''def parallelize(barcodes:tuple, samples:dict, num_chunks:int, forward_fastq:str,
                 reverse_fastq:Optional(str) = None)'''
-    parallelize(sample_dict, args['forward'], args['num_lines'], reverse_fastq = args['reverse'])
+    parallelize(
+        sample_dict=sample_dict,
+        num_lines=args['numlines'],
+        forward_fastq=args['forward'],
+        reverse_fastq=args['reverse'],
+        error_rate=args['error'],
+        offset=args['offset'],
+        compression=args['compress'],
+        threads=args['threads'],
+        matcher=args['matcher'],
+        layouts=layouts,
+        shift=args['shift'],
+        profile=args['profile'],
+        resume=args['resume'],
+        output_dir=args['output'],
+        dual_index=args['dual_index'],
+        scheduler=args['scheduler'],
+        max_memory=args['max_memory'],
+        extract_umis=args['extract_umis'],
+        lanes=lanes,
+        output_name=output_name
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""Benchmark BarcSeek on synthetic FASTQ files and keep the results for comparison"""
+
+import sys
+if sys.version_info.major is not 3 and sys.version_info.minor < 5:
+    sys.exit("Please use Python 3.5 or higher for this program")
+
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from typing import Optional, Callable, Tuple, List, Dict, Any
+
+try:
+    import fastq
+    import partition
+    import parallel
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.cases'))
+    import generator
+except ImportError:
+    sys.exit("Please leave this program in its directory to load custom modules")
+
+
+RESULTS_FILE = 'benchmark_results.json' # type: str
+#   How many reads 'match_barcode' is timed on, it compiles its barcodes for every read
+MATCH_READS = 20000 # type: int
+
+
+def _files(case: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    return case['forward'], case['reverse']
+
+
+def bench_read_fastq(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Read every read into memory with fastq.read_fastq"""
+    forward, reverse = _files(case) # type: str, Optional[str]
+    return len(fastq.read_fastq(fastq=forward, pair=reverse))
+
+
+def bench_match_barcode(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Match reads against one sample's barcodes with partition.match_barcode"""
+    forward, reverse = _files(case) # type: str, Optional[str]
+    barcodes = next(iter(case['samples'].values())) # type: List[str]
+    count = 0 # type: int
+    for read in fastq.iter_fastq(fastq=forward, pair=reverse): # type: fastq.Read
+        if count == MATCH_READS:
+            break
+        partition.match_barcode(read=read, barcodes=barcodes, error_rate=options['error_rate'])
+        count += 1
+    return count
+
+
+def _partition(case: Dict[str, Any], options: Dict[str, Any], **kwargs) -> int:
+    forward, reverse = _files(case) # type: str, Optional[str]
+    counts = partition.partition( # type: Dict[str, Any]
+        barcodes=case['samples'],
+        filename=forward,
+        reverse=reverse,
+        error_rate=options['error_rate'],
+        **kwargs
+    )
+    return counts['reads']
+
+
+def bench_partition(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Partition every read in one process with regex matching"""
+    return _partition(case, options)
+
+
+def bench_partition_index(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Partition every read in one process with the lookup table matcher"""
+    return _partition(case, options, offset=options['offset'], matcher='index')
+
+
+def bench_partition_matrix(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Partition every read in one process with the NumPy matrix matcher"""
+    return _partition(case, options, offset=options['offset'], matcher='matrix')
+
+
+def bench_parallelize(case: Dict[str, Any], options: Dict[str, Any]) -> int:
+    """Partition every read end to end: chunking, workers, joining outputs, and the report"""
+    forward, reverse = _files(case) # type: str, Optional[str]
+    report = parallel.parallelize( # type: Dict[str, Any]
+        sample_dict=case['samples'],
+        num_lines=options['num_lines'],
+        forward_fastq=forward,
+        reverse_fastq=reverse,
+        error_rate=options['error_rate'],
+        threads=options['threads']
+    )
+    return report['reads']
+
+
+BENCHMARKS = { # type: Dict[str, Callable[[Dict[str, Any], Dict[str, Any]], int]]
+    'read_fastq': bench_read_fastq,
+    'match_barcode': bench_match_barcode,
+    'partition': bench_partition,
+    'partition_index': bench_partition_index,
+    'partition_matrix': bench_partition_matrix,
+    'parallelize': bench_parallelize
+}
+
+
+def _peak_rss() -> int:
+    """The peak resident set size of this process and its finished children, in kilobytes"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) # type: int
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def _measure(name: str, case: Dict[str, Any], options: Dict[str, Any], connection) -> None:
+    """Run one benchmark and send back its timings, run in a fresh process so peak RSS is its own"""
+    try:
+        wall, cpu = time.perf_counter(), time.process_time() # type: float, float
+        reads = BENCHMARKS[name](case, options) # type: int
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        connection.send({
+            'reads': reads,
+            'seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'reads_per_second': round(reads / wall, 1) if wall else None,
+            'peak_rss_kb': _peak_rss()
+        })
+    except Exception as error:
+        connection.send({'error': repr(error)})
+    finally:
+        connection.close()
+
+
+def _stage(case: Dict[str, Any], directory: str) -> Dict[str, Any]:
+    """Link the test case's FASTQ files into a directory of their own, so outputs don't collide"""
+    os.makedirs(directory)
+    staged = dict(case) # type: Dict[str, Any]
+    for key in ('forward', 'reverse'): # type: str
+        if case[key]:
+            staged[key] = os.path.join(directory, os.path.basename(case[key]))
+            try:
+                os.link(case[key], staged[key])
+            except OSError:
+                shutil.copyfile(case[key], staged[key])
+    return staged
+
+
+def run(name: str, case: Dict[str, Any], options: Dict[str, Any], directory: str) -> Dict[str, Any]:
+    """Run one benchmark in a fresh process on its own copy of the test case
+    name [str]:                 The benchmark to run, one of BENCHMARKS
+    case [Dict[str, Any]]:      The test case from generator.generate
+    options [Dict[str, Any]]:   Options for the benchmark: 'error_rate', 'offset', 'num_lines',
+                                    and 'threads'
+    directory [str]:            A new directory to run in
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    worker = context.Process(target=_measure, args=(name, _stage(case, directory), options, sender))
+    worker.start()
+    sender.close()
+    try:
+        result = receiver.recv() # type: Dict[str, Any]
+    except EOFError:
+        result = {'error': 'exited with code %s' % worker.exitcode}
+    worker.join()
+    return result
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(results_file: str) -> List[Dict[str, Any]]:
+    """Load the stored benchmark runs, oldest first"""
+    if not os.path.exists(results_file):
+        return list()
+    with open(results_file) as rfile:
+        return json.load(rfile)
+
+
+def save_results(results_file: str, runs: List[Dict[str, Any]]) -> None:
+    """Store benchmark runs, replacing the results file once it is written"""
+    temp_file = results_file + '.tmp' # type: str
+    with open(temp_file, 'w') as rfile:
+        json.dump(runs, rfile, indent=2)
+        rfile.write('\n')
+    os.replace(temp_file, results_file)
+
+
+def compare(current: Dict[str, Any], previous: Optional[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Print a table of reads per second and peak RSS against a previous run
+    current [Dict[str, Any]]:   The run just made
+    previous [Dict[str, Any]]:  The run to compare against, if any
+    tolerance [float]:          How much slower, as a fraction, a benchmark may be before it regresses
+
+    Returns the names of the benchmarks that regressed
+    """
+    regressions = list() # type: List[str]
+    print('%-18s %14s %14s %8s %12s' % ('benchmark', 'reads/sec', 'previous', 'ratio', 'peak RSS KB'))
+    for name, result in current['results'].items(): # type: str, Dict[str, Any]
+        if 'error' in result:
+            print('%-18s %s' % (name, result['error']))
+            continue
+        before = (previous or dict()).get('results', dict()).get(name, dict()).get('reads_per_second') # type: Optional[float]
+        ratio = result['reads_per_second'] / before if before else None # type: Optional[float]
+        print('%-18s %14.1f %14s %8s %12i' % (
+            name,
+            result['reads_per_second'],
+            '%.1f' % before if before else '-',
+            '%.2f' % ratio if ratio else '-',
+            result['peak_rss_kb']
+        ))
+        if ratio is not None and ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+#   A function to create an argument parser
+def _set_args():
+    parser = argparse.ArgumentParser( # type: argparse.ArgumentParser
+        description="Benchmark BarcSeek on synthetic FASTQ files, storing reads/sec and peak RSS for comparison",
+        formatter_class=argparse.RawTextHelpFormatter,
+        add_help=True
+    )
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', type=str, nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), metavar='BENCHMARK',
+                        help="Benchmarks to run, any of:\n%s\n[OPTIONAL, DEFAULT=all]" % ', '.join(BENCHMARKS))
+    parser.add_argument('-n', '--reads', dest='reads', type=int, default=100000, metavar='READS',
+                        help="How many reads to generate.\n[OPTIONAL, DEFAULT=100000]")
+    parser.add_argument('-s', '--samples', dest='samples', type=int, default=12, metavar='SAMPLES',
+                        help="How many samples to generate.\n[OPTIONAL, DEFAULT=12]")
+    parser.add_argument('-2', '--dual', dest='dual', action='store_true',
+                        help="Generate paired reads with two barcodes per sample.\n[OPTIONAL]")
+    parser.add_argument('-e', '--error', dest='error_rate', type=int, default=1, metavar='ERROR',
+                        help="Mismatches allowed in the barcodes.\n[OPTIONAL, DEFAULT=1]")
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=None, metavar='THREADS',
+                        help="Worker processes for parallelize.\n[OPTIONAL, DEFAULT=all cores]")
+    parser.add_argument('-l', '--numlines', dest='num_lines', type=int, default=40000, metavar='NUMLINES',
+                        help="Lines per chunk for parallelize.\n[OPTIONAL, DEFAULT=40000]")
+    parser.add_argument('-o', '--results', dest='results', type=str, default=RESULTS_FILE, metavar='RESULTS',
+                        help="JSON file to add this run to and compare against.\n[OPTIONAL, DEFAULT=%s]" % RESULTS_FILE)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.1, metavar='TOLERANCE',
+                        help="Exit with an error if reads/sec drops by more than this\nfraction of the last comparable run.\n[OPTIONAL, DEFAULT=0.1]")
+    parser.add_argument('--no-save', dest='save', action='store_false',
+                        help="Compare without storing this run.\n[OPTIONAL]")
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help="Keep the generated files and outputs.\n[OPTIONAL]")
+    return parser
+
+
+def main(args: Dict[str, Any]) -> int:
+    '''Run the benchmarks'''
+    parameters = {
+        'reads': args['reads'],
+        'samples': args['samples'],
+        'dual': args['dual'],
+        'error_rate': args['error_rate'],
+        'threads': args['threads'] or os.cpu_count(),
+        'num_lines': args['num_lines']
+    } # type: Dict[str, Any]
+    options = dict(parameters, offset=0) # type: Dict[str, Any]
+    directory = tempfile.mkdtemp(prefix='barcseek_benchmark_') # type: str
+    try:
+        case = generator.generate( # type: Dict[str, Any]
+            output_directory=os.path.join(directory, 'case'),
+            reads=args['reads'],
+            samples=args['samples'],
+            dual=args['dual']
+        )
+        current = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'parameters': parameters,
+            'results': dict()
+        } # type: Dict[str, Any]
+        for name in args['benchmarks']: # type: str
+            current['results'][name] = run(name, case, options, os.path.join(directory, name))
+    finally:
+        if args['keep']:
+            print("Files kept in " + directory)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    runs = load_results(args['results']) # type: List[Dict[str, Any]]
+    previous = next((run for run in reversed(runs) if run['parameters'] == parameters), None) # type: Optional[Dict[str, Any]]
+    regressions = compare(current, previous, args['tolerance']) # type: List[str]
+    if args['save']:
+        save_results(args['results'], runs + [current])
+    if regressions:
+        print("Slower than the last comparable run: " + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    PARSER = _set_args() # type: argparse.ArgumentParser
+    ARGS = vars(PARSER.parse_args()) # type: Dict[str, Any]
+    sys.exit(main(ARGS))
@@ -7,12 +7,36 @@ if sys.version_info.major is not 3 and sys.version_info.minor < 5:
     sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
 
 
-from typing import Optional, Tuple, Any
+import io
+import os
+import gzip
+import mmap
+import zlib
+import stat
+import struct
+import itertools
+from collections import deque, OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Union, Tuple, List, Dict, Set, Iterator, Deque, Callable, Any
 
-try:
-    from Bio.SeqIO import QualityIO
-except ImportError as error:
-    sys.exit("Please install " + error.name)
+BUFFER_SIZE = 1024 * 1024 # type: int
+SEARCH_WINDOW = 1024 * 1024 # type: int
+GZIP_MAGIC = b'\x1f\x8b' # type: bytes
+COMPRESSION = ('gzip', 'bgzf') # type: Tuple[str, str]
+COMPRESS_LEVEL = 6 # type: int
+DECOMPRESS_THREADS = 4 # type: int
+WRITE_BUFFER = 1024 * 1024 # type: int
+MAX_BUFFERED = 256 * 1024 * 1024 # type: int
+MAX_OPEN_FILES = 256 # type: int
+#   Uncompressed data per BGZF block, as used by bgzip and htslib
+BGZF_BLOCK_SIZE = 65280 # type: int
+#   Joins a UMI to the read name, as in UMI-tools' '@NAME_UMI COMMENT' headers
+UMI_SEPARATOR = '_' # type: str
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000') # type: bytes
+#   The filename for standard input, and the name its output is given
+STDIN = '-' # type: str
+STDIN_NAME = 'stdin.fastq' # type: str
 
 
 class Read(object):
@@ -21,15 +45,29 @@ class Read(object):
     This object represents read information from a FASTQ file (or paired FASTQ files)
     It contains the read ID, sequence, and quality scores, as well as optional
     reverse sequence and reverse quality scores for paired-end data
+    Sequences are kept as read; trims are recorded as offsets into them and
+    only applied when the read is written out in FASTQ format, as is a UMI
+    moved into the read IDs
     """
 
-    def __init__(self, read_id: str, seq: str, qual: str, rev: Optional[str]=None, rev_qual: Optional[str]=None) -> None:
+    __slots__ = ('_id', '_seq', '_qual', '_rseq', '_rqual', '_rid', '_cuts', '_rcuts', '_umi')
+
+    def __init__(
+            self,
+            read_id: str,
+            seq: str,
+            qual: str,
+            rev: Optional[str]=None,
+            rev_qual: Optional[str]=None,
+            rev_id: Optional[str]=None
+    ) -> None:
         """
     read_id [str]:          The read ID
     seq [str]:              The forward or only sequence
     qual [str]              The quality scores for 'seq'
     rev [str]=None          Optional reverse sequence
     rev_qual [str]=None     Optional quality scores for 'rev'
+    rev_id [str]=None       Optional read ID of the reverse read, defaults to 'read_id'
 
     If 'rev' is provided, 'rev_qual' must also be provided
     """
@@ -38,6 +76,10 @@ class Read(object):
         self._qual = qual
         self._rseq = rev
         self._rqual = rev_qual
+        self._rid = rev_id
+        self._cuts = None # type: Optional[List[Tuple[int, Optional[int]]]]
+        self._rcuts = None # type: Optional[List[Tuple[int, Optional[int]]]]
+        self._umi = None # type: Optional[str]
         self._validate()
 
     def __repr__(self) -> str:
@@ -72,53 +114,81 @@ class Read(object):
     def _reverse(self) -> str:
         return self._rseq
 
+    def _get_umi(self) -> Optional[str]:
+        return self._umi
+
     def _fastq(self, reverse: bool=False) -> str:
         if reverse:
             if not self.paired:
                 return None
+            rev_id = _tag_umi(self._rid or self.read_id, self._umi) # type: str
             out = (
-                '@' + self.read_id,
-                self._rseq,
-                '+' + self.read_id,
-                self._rqual
+                '@' + rev_id,
+                _cut(self._rseq, self._rcuts),
+                '+' + rev_id,
+                _cut(self._rqual, self._rcuts)
             )
         else:
+            read_id = _tag_umi(self.read_id, self._umi) # type: str
             out = (
-                '@' + self.read_id,
-                self._seq,
-                '+' + self.read_id,
-                self._qual
+                '@' + read_id,
+                _cut(self._seq, self._cuts),
+                '+' + read_id,
+                _cut(self._qual, self._cuts)
             )
         return '\n'.join(out)
 
     def _rev_fastq(self) -> str:
         return self._fastq(reverse=True)
 
-    def add_reverse(self, seq: str, qual: str) -> None:
+    def add_reverse(self, seq: str, qual: str, read_id: Optional[str]=None) -> None:
         """Add a reverse read and quality score
-        seq [str]:  Reverse sequence for this read
-        qual [str]: Reverse quality score for this read
+        seq [str]:          Reverse sequence for this read
+        qual [str]:         Reverse quality score for this read
+        read_id [str]=None  Optional read ID of the reverse read
         """
         self._rseq = seq
         self._rqual = qual
+        self._rid = read_id
         self._validate()
 
+    def add_umi(self, umi: str) -> None:
+        """Add UMI bases to the read IDs, after any added before
+        umi [str]:  The UMI bases, which should also be trimmed from the read
+        """
+        self._umi = (self._umi or '') + umi
+
+    def copy(self) -> 'Read':
+        """Make a copy of this read that shares its sequences but not its trims"""
+        other = Read.__new__(Read) # type: Read
+        for attr in self.__slots__: # type: str
+            setattr(other, attr, getattr(self, attr))
+        other._cuts = list(self._cuts) if self._cuts else None
+        other._rcuts = list(self._rcuts) if self._rcuts else None
+        return other
+
     def trim(self, start: int, end: Optional[int]=None, reverse: bool=False) -> None:
         """Trim some sequence from the read (0-based)
         start [int]:            Where do we start trimming?
         end [int]:              Where do we end trimming?
         reverse [bool]=False    Are we trimming from the reverse read?
+
+        Positions are always relative to the untrimmed sequence,
+        and an 'end' of None or 0 trims to the end of the read
         """
         if end and start > end:
             raise ValueError("'start' cannot be greater than 'end'")
+        end = end or None # type: Optional[int]
         if reverse:
             if not self.paired:
                 raise ValueError("Cannot trim a nonexistant reverse read")
-            self._rseq = self._rseq[:start] + (self._rseq[end:] if end else '')
-            self._rqual = self._rqual[:start] + (self._rqual[end:] if end else '')
+            if self._rcuts is None:
+                self._rcuts = list()
+            self._rcuts.append((start, end))
         else:
-            self._seq = self._seq[:start] + (self._seq[end:] if end else '')
-            self._qual = self._qual[:start] + (self._qual[end:] if end else '')
+            if self._cuts is None:
+                self._cuts = list()
+            self._cuts.append((start, end))
 
     read_id = property(fget=__repr__, doc='The read ID')
     name = read_id
@@ -127,20 +197,519 @@ class Read(object):
     paired = property(fget=_is_paired, doc='Is this read paired?')
     fastq = property(fget=_fastq, doc='Read in FASTQ format')
     reverse_fastq = property(fget=_rev_fastq, doc='Reverse read in FASTQ format')
+    umi = property(fget=_get_umi, doc='UMI added to the read IDs')
+
+
+def _tag_umi(read_id: str, umi: Optional[str]) -> str:
+    """Add a UMI to the end of the first word of a read ID"""
+    if umi is None:
+        return read_id
+    name, space, comment = read_id.partition(' ') # type: str, str, str
+    return name + UMI_SEPARATOR + umi + space + comment
+
+
+def _cut(seq: str, cuts: Optional[List[Tuple[int, Optional[int]]]]) -> str:
+    """Remove (start, end) spans from a sequence, an end of None runs to the end"""
+    if not cuts:
+        return seq
+    pieces = list() # type: List[str]
+    position = 0 # type: int
+    for start, end in sorted(cuts, key=lambda cut: cut[0]): # type: int, Optional[int]
+        if start > position:
+            pieces.append(seq[position:start])
+        if end is None:
+            position = len(seq)
+            break
+        position = max(position, end)
+    pieces.append(seq[position:])
+    return ''.join(pieces)
+
+
+def read_id_stem(read_id: str) -> str:
+    """Get the part of a read ID shared by both reads of a pair
+    read_id [str]:  A read ID, with or without its description
+
+    Drops the description after the first whitespace (Casava-style '1:N:0')
+    and a trailing '/1' or '/2'
+    """
+    stem = read_id.split(None, 1)[0] if read_id.strip() else '' # type: str
+    if stem.endswith(('/1', '/2')):
+        stem = stem[:-2]
+    return stem
+
+
+class _RangeReader(io.RawIOBase):
+
+    """A raw, read-only view of the bytes between 'start' and 'end' of a file,
+    keeping the CRC32 of the bytes read so far in 'crc'
+    """
+
+    def __init__(self, filename: str, start: int=0, end: Optional[int]=None) -> None:
+        super().__init__()
+        self._handle = open(filename, 'rb', buffering=0) # type: _io.FileIO
+        self._handle.seek(start)
+        self._remaining = None if end is None else end - start # type: Optional[int]
+        self.crc = 0 # type: int
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if self._remaining is not None and self._remaining <= 0:
+            return 0
+        view = memoryview(buffer) if self._remaining is None else memoryview(buffer)[:self._remaining] # type: memoryview
+        count = self._handle.readinto(view) # type: int
+        if self._remaining is not None:
+            self._remaining -= count
+        self.crc = zlib.crc32(view[:count], self.crc)
+        return count
+
+    def close(self) -> None:
+        self._handle.close()
+        super().close()
+
+
+def is_stream(fastq: str) -> bool:
+    """Is a FASTQ file standard input ('-'), a named pipe, or anything else that can only be read once in order?"""
+    if fastq == STDIN:
+        return True
+    return not stat.S_ISREG(os.stat(fastq).st_mode)
+
+
+def _open_stream(fastq: str) -> io.TextIOBase:
+    """Open standard input or a named pipe for reading text, decompressing gzip and BGZF
+    streams, which are recognized without consuming any of the stream"""
+    handle = sys.stdin.buffer if fastq == STDIN else open(fastq, 'rb', buffering=BUFFER_SIZE) # type: io.BufferedReader
+    if handle.peek(2)[:2] == GZIP_MAGIC:
+        return io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(fileobj=handle, mode='rb'), buffer_size=BUFFER_SIZE))
+    return io.TextIOWrapper(handle)
+
+
+def is_compressed(fastq: str) -> bool:
+    """Is a file gzip-compressed (including BGZF)?"""
+    with open(fastq, 'rb') as handle: # type: _io.BufferedReader
+        return handle.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(fastq: str) -> bool:
+    """Is a file BGZF-compressed, i.e. gzip with independent blocks that record their own size?"""
+    with open(fastq, 'rb') as handle: # type: _io.BufferedReader
+        return _bgzf_block_size(handle.read(18)) is not None
+
+
+def _bgzf_block_size(header: bytes) -> Optional[int]:
+    """Get the total size of a BGZF block from its header, or None if it is not a BGZF block"""
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        return None
+    xlen, = struct.unpack('<H', header[10:12]) # type: int
+    extra = header[12:12 + xlen] # type: bytes
+    position = 0 # type: int
+    while position + 4 <= len(extra):
+        slen, = struct.unpack('<H', extra[position + 2:position + 4]) # type: int
+        if extra[position:position + 2] == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+        position += 4 + slen
+    return None
+
+
+def _inflate(block: bytes) -> bytes:
+    """Decompress one BGZF block and check it against its CRC"""
+    xlen, = struct.unpack('<H', block[10:12]) # type: int
+    data = zlib.decompress(block[12 + xlen:-8], -15) # type: bytes
+    crc, size = struct.unpack('<II', block[-8:]) # type: int, int
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise ValueError("Corrupt BGZF block")
+    return data
+
+
+class _BgzfReader(io.RawIOBase):
+
+    """A raw, read-only stream of a BGZF file whose blocks are decompressed in parallel
+    zlib releases the GIL, so blocks are inflated on a pool of threads ahead of the reader
+    """
+
+    def __init__(self, filename: str, threads: int=DECOMPRESS_THREADS) -> None:
+        super().__init__()
+        self._handle = open(filename, 'rb') # type: _io.BufferedReader
+        self._pool = ThreadPoolExecutor(max_workers=threads) # type: ThreadPoolExecutor
+        self._ahead = threads * 4 # type: int
+        self._pending = deque() # type: Deque[Future]
+        self._buffer = b'' # type: bytes
+        self._offset = 0 # type: int
+        self._done = False # type: bool
+        self._fill()
+
+    def _fill(self) -> None:
+        while not self._done and len(self._pending) < self._ahead:
+            header = self._handle.read(18) # type: bytes
+            if not header:
+                self._done = True
+                break
+            size = _bgzf_block_size(header) # type: Optional[int]
+            if size is None:
+                raise ValueError("'%s' is not a BGZF file" % self._handle.name)
+            block = header + self._handle.read(size - len(header)) # type: bytes
+            self._pending.append(self._pool.submit(_inflate, block))
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while self._offset >= len(self._buffer):
+            if not self._pending:
+                return 0
+            self._buffer = self._pending.popleft().result()
+            self._offset = 0
+            self._fill()
+        count = min(len(buffer), len(self._buffer) - self._offset) # type: int
+        buffer[:count] = self._buffer[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+        self._handle.close()
+        super().close()
+
+
+def bgzf_compress(data: bytes, level: int=COMPRESS_LEVEL) -> bytes:
+    """Compress data into BGZF blocks, which can be joined by concatenation
+    data [bytes]:                   The data to compress
+    level [int]=COMPRESS_LEVEL      The zlib compression level
+    """
+    blocks = list() # type: List[bytes]
+    for start in range(0, len(data), BGZF_BLOCK_SIZE): # type: int
+        chunk = data[start:start + BGZF_BLOCK_SIZE] # type: bytes
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # type: zlib.Compress
+        cdata = compressor.compress(chunk) + compressor.flush() # type: bytes
+        blocks.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        blocks.append(cdata)
+        blocks.append(struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return b''.join(blocks)
+
+
+class WriterPool(object):
+
+    """Buffered writers for many output files with a bounded number of open files
+    Text for each file is held in memory and written once 'buffer_size' characters build up,
+    or once every buffer together holds 'max_buffered' characters. At most 'max_open' files
+    are open at once; the least recently used one is closed and reopened in append mode the
+    next time it is written to. Compressed output is written as one gzip member, or a run of
+    BGZF blocks, per flush, which both decompress as one stream
+    """
+
+    def __init__(
+            self,
+            compression: Optional[str]=None,
+            buffer_size: int=WRITE_BUFFER,
+            max_buffered: int=MAX_BUFFERED,
+            max_open: int=MAX_OPEN_FILES
+    ) -> None:
+        """
+    compression [str]=None              None for plain text, or one of COMPRESSION
+    buffer_size [int]=WRITE_BUFFER      Characters to buffer per file before writing it out
+    max_buffered [int]=MAX_BUFFERED     Characters to buffer across all files before writing them out
+    max_open [int]=MAX_OPEN_FILES       Most files to have open at once
+    """
+        if compression and compression not in COMPRESSION:
+            raise ValueError("Unknown compression '%s', choose from %s" % (compression, ', '.join(COMPRESSION)))
+        if max_open < 1:
+            raise ValueError("'max_open' must be at least 1")
+        self._compression = compression # type: Optional[str]
+        self._buffer_size = buffer_size # type: int
+        self._max_buffered = max_buffered # type: int
+        self._max_open = max_open # type: int
+        self._buffers = dict() # type: Dict[str, List[str]]
+        self._sizes = dict() # type: Dict[str, int]
+        self._buffered = 0 # type: int
+        self._handles = OrderedDict() # type: OrderedDict[str, _io.BufferedWriter]
+        self._started = set() # type: Set[str]
+
+    def __enter__(self) -> 'WriterPool':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def add(self, filename: str) -> None:
+        """Register an output file, so it is created even if nothing is written to it"""
+        if filename not in self._buffers:
+            self._buffers[filename] = list()
+            self._sizes[filename] = 0
+
+    def write(self, filename: str, text: str) -> None:
+        """Write text to an output file
+        filename [str]: The file to write to
+        text [str]:     The text to write
+        """
+        if filename not in self._buffers:
+            self.add(filename)
+        self._buffers[filename].append(text)
+        self._sizes[filename] += len(text)
+        self._buffered += len(text)
+        if self._sizes[filename] >= self._buffer_size:
+            self._flush(filename)
+        elif self._buffered >= self._max_buffered:
+            self.flush()
+
+    def _flush(self, filename: str) -> None:
+        if not self._buffers[filename]:
+            return
+        data = ''.join(self._buffers[filename]).encode() # type: bytes
+        self._buffered -= self._sizes[filename]
+        self._buffers[filename] = list()
+        self._sizes[filename] = 0
+        if self._compression == 'gzip':
+            data = gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+        elif self._compression == 'bgzf':
+            data = bgzf_compress(data)
+        self._open(filename).write(data)
+
+    def _open(self, filename: str) -> '_io.BufferedWriter':
+        handle = self._handles.get(filename) # type: Optional[_io.BufferedWriter]
+        if handle is not None:
+            self._handles.move_to_end(filename)
+            return handle
+        while len(self._handles) >= self._max_open:
+            self._handles.popitem(last=False)[1].close()
+        handle = open(filename, 'ab' if filename in self._started else 'wb')
+        self._started.add(filename)
+        self._handles[filename] = handle
+        return handle
+
+    def flush(self) -> None:
+        """Write out every buffer"""
+        for filename in self._buffers: # type: str
+            self._flush(filename)
+
+    def close(self) -> None:
+        """Write out every buffer, create files that were never written to, and close every file"""
+        self.flush()
+        for filename in self._buffers: # type: str
+            handle = self._open(filename) # type: _io.BufferedWriter
+            if self._compression == 'bgzf':
+                handle.write(BGZF_EOF)
+        for handle in self._handles.values(): # type: _io.BufferedWriter
+            handle.close()
+        self._handles.clear()
+        self._buffers.clear()
+        self._sizes.clear()
+
+
+def output_basename(filename: str, compression: Optional[str]=None) -> str:
+    """Get the basename for output from a FASTQ filename, with a '.gz' suffix if compressed
+    filename [str]:             The input FASTQ filename
+    compression [str]=None      None for plain text, or one of COMPRESSION
+    """
+    basename = STDIN_NAME if filename == STDIN else os.path.basename(filename) # type: str
+    if basename.endswith('.gz'):
+        basename = basename[:-3]
+    return basename + '.gz' if compression else basename
+
+
+def open_fastq(fastq: str, byte_range: Optional[Tuple[int, int]]=None) -> io.TextIOBase:
+    """Open a FASTQ file, or a range of bytes within one, for reading text
+    fastq [str]:                            The FASTQ filename, gzip and BGZF files are decompressed,
+                                                '-' reads standard input
+    byte_range [Tuple[int, int]]=None       Optional (start, end) byte offsets to read between,
+                                                only for uncompressed files that are not streams
+    """
+    if is_stream(fastq):
+        if byte_range:
+            raise ValueError("Cannot read a byte range of stream '%s'" % fastq)
+        return _open_stream(fastq)
+    if is_compressed(fastq):
+        if byte_range:
+            raise ValueError("Cannot read a byte range of compressed file '%s'" % fastq)
+        if is_bgzf(fastq):
+            return io.TextIOWrapper(io.BufferedReader(_BgzfReader(filename=fastq), buffer_size=BUFFER_SIZE))
+        return io.TextIOWrapper(gzip.open(fastq, 'rb'))
+    start, end = byte_range if byte_range else (0, None) # type: int, Optional[int]
+    return io.TextIOWrapper(io.BufferedReader(_RangeReader(filename=fastq, start=start, end=end), buffer_size=BUFFER_SIZE))
+
+
+def _record_start(data: mmap.mmap, position: int) -> int:
+    """Find the first record starting at or after 'position'
+    A record starts with an '@' at the start of a line, and is only accepted
+    when its third line starts with a '+', as quality lines may start with '@' too
+    """
+    if position <= 0:
+        return 0
+    size = len(data) # type: int
+    while True:
+        position = data.find(b'\n@', position - 1)
+        if position < 0:
+            return size
+        position += 1
+        header_end = data.find(b'\n', position) # type: int
+        plus_start = data.find(b'\n', header_end + 1) + 1 if header_end >= 0 else 0 # type: int
+        if plus_start <= 0 or plus_start >= size:
+            return size
+        if data[plus_start:plus_start + 1] == b'+':
+            return position
+        position += 1
+
+
+def _header_stem(data: mmap.mmap, position: int) -> bytes:
+    """Get the read ID stem of the record starting at 'position'"""
+    end = data.find(b'\n', position) # type: int
+    header = data[position + 1:end if end >= 0 else len(data)].decode() # type: str
+    return read_id_stem(header).encode()
+
+
+def _find_record(data: mmap.mmap, stem: bytes, guess: int) -> int:
+    """Find the record with a read ID stem, searching outwards from a guessed position"""
+    size = len(data) # type: int
+    if data[:len(stem) + 1] == b'@' + stem and _header_stem(data, 0) == stem:
+        return 0
+    needle = b'\n@' + stem # type: bytes
+    window = SEARCH_WINDOW # type: int
+    while True:
+        start = max(0, guess - window) # type: int
+        end = min(size, guess + window) # type: int
+        position = data.find(needle, start, end) # type: int
+        while position >= 0:
+            if _header_stem(data, position + 1) == stem:
+                return position + 1
+            position = data.find(needle, position + 1, end)
+        if start == 0 and end == size:
+            raise ValueError("Cannot find read '%s' in the paired FASTQ file" % stem.decode())
+        window *= 2
+
+
+def chunk_fastq(
+        fastq: str,
+        chunk_size: Union[int, Callable[[int], int]],
+        pair: Optional[str]=None
+) -> List[Tuple[Tuple[int, int], Optional[Tuple[int, int]]]]:
+    """Split a FASTQ file, and optionally its pair, into record-aligned byte ranges
+    fastq [str]:        The forward or only FASTQ filename
+    chunk_size [int, Callable[[int], int]]: The approximate number of bytes per chunk of 'fastq',
+                                                or a function of the bytes left to split that
+                                                gives the size of the next chunk
+    pair [str]=None     Optional reverse FASTQ filename
+
+    Returns a list of ((start, end), (start, end) or None) byte ranges, one per chunk,
+    ranges of paired files start at the same reads. Compressed files and streams
+    cannot be split, and are returned as one chunk with no ranges
+    """
+    if not callable(chunk_size):
+        if chunk_size <= 0:
+            raise ValueError("'chunk_size' must be positive")
+        fixed = chunk_size # type: int
+        chunk_size = lambda remaining: fixed
+    if any(is_stream(name) or is_compressed(name) for name in filter(None, (fastq, pair))):
+        return [(None, None)]
+    with ExitStack() as stack: # type: ExitStack
+        forward = _map(stack, fastq) # type: Optional[mmap.mmap]
+        if forward is None:
+            return list()
+        if forward[:1] != b'@':
+            raise ValueError("'%s' is not a FASTQ file" % fastq)
+        size = len(forward) # type: int
+        starts = [0] # type: List[int]
+        while True:
+            step = chunk_size(size - starts[-1]) # type: int
+            if step <= 0:
+                raise ValueError("'chunk_size' must be positive")
+            position = _record_start(forward, starts[-1] + step) # type: int
+            if position >= size:
+                break
+            starts.append(position)
+        forward_ranges = list(zip(starts, starts[1:] + [size])) # type: List[Tuple[int, int]]
+        if not pair:
+            return [(forward_range, None) for forward_range in forward_ranges]
+        reverse = _map(stack, pair) # type: Optional[mmap.mmap]
+        if reverse is None:
+            raise ValueError("'%s' and '%s' do not have the same number of reads" % (fastq, pair))
+        ratio = len(reverse) / size # type: float
+        reverse_starts = [0] + [_find_record(reverse, _header_stem(forward, start), int(start * ratio)) for start in starts[1:]] # type: List[int]
+        reverse_ranges = list(zip(reverse_starts, reverse_starts[1:] + [len(reverse)])) # type: List[Tuple[int, int]]
+        return list(zip(forward_ranges, reverse_ranges))
+
+
+def _map(stack: ExitStack, filename: str) -> Optional[mmap.mmap]:
+    """Memory-map a file for reading, returns None for empty files"""
+    handle = stack.enter_context(open(filename, 'rb')) # type: _io.BufferedReader
+    if not os.fstat(handle.fileno()).st_size:
+        return None
+    return stack.enter_context(mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def parse_fastq(handle: Iterator[str]) -> Iterator[Tuple[str, str, str]]:
+    """Parse four-line FASTQ records into (title, sequence, quality) tuples
+    'handle' an open FASTQ file, or any iterator over its lines
+
+    Blank lines at the end of the file are ignored; records that do not start
+    with '@', lack a '+' line, are cut short, or have a quality string of a
+    different length than their sequence raise a ValueError"""
+    lines = iter(handle) # type: Iterator[str]
+    for title, seq, plus, qual in itertools.zip_longest(lines, lines, lines, lines): # type: str, str, str, str
+        if title[:1] != '@':
+            if not title.strip() and not any(line and line.strip() for line in (seq, plus, qual)):
+                if not any(line.strip() for line in lines):
+                    return
+            raise ValueError("FASTQ records should start with '@', not %r" % title[:50])
+        if qual is None:
+            raise ValueError("The FASTQ record '%s' is cut short" % title[1:].rstrip())
+        if plus[:1] != '+':
+            raise ValueError("The FASTQ record '%s' has no '+' line" % title[1:].rstrip())
+        seq, qual = seq.rstrip(), qual.rstrip()
+        if len(seq) != len(qual):
+            raise ValueError("The FASTQ record '%s' has %i bases but %i qualities" % (title[1:].rstrip(), len(seq), len(qual)))
+        yield title[1:].rstrip(), seq, qual
+
+
+def iter_fastq(
+        fastq: str,
+        pair: Optional[str]=None,
+        forward_range: Optional[Tuple[int, int]]=None,
+        reverse_range: Optional[Tuple[int, int]]=None,
+        checksums: Optional[List[int]]=None
+) -> Iterator[Read]:
+    """Stream reads from a FASTQ file, and optionally its pair, one at a time
+    'fastq' the filename for the forward or only FASTQ file, '-' for standard input,
+        or a named pipe
+    'pair' an optional filename for the reverse FASTQ file
+    'forward_range' and 'reverse_range' optional (start, end) byte ranges, from 'chunk_fastq', to read
+    'checksums' an optional list to add the CRC32 of the bytes read from each uncompressed file to,
+        once every read has been yielded, so that a chunk is checksummed without reading it twice
+
+    Paired files are read in lockstep, so both must list their reads in the same order"""
+    with open_fastq(fastq, forward_range) as ffile: # type: io.TextIOWrapper
+        forward = parse_fastq(ffile) # type: Iterator[Tuple[str, str, str]]
+        if not pair:
+            for read_id, seq, qual in forward: # type: str, str, str
+                yield Read(read_id=read_id, seq=seq, qual=qual)
+            _add_checksums(checksums, ffile)
+            return
+        with open_fastq(pair, reverse_range) as rfile: # type: io.TextIOWrapper
+            reverse = parse_fastq(rfile) # type: Iterator[Tuple[str, str, str]]
+            for fread, rread in itertools.zip_longest(forward, reverse): # type: Tuple[str, str, str], Tuple[str, str, str]
+                if fread is None or rread is None:
+                    raise ValueError("'%s' and '%s' do not have the same number of reads" % (fastq, pair))
+                read_id, seq, qual = fread # type: str, str, str
+                rev_id, rev, rev_qual = rread # type: str, str, str
+                if read_id_stem(read_id) != read_id_stem(rev_id):
+                    raise ValueError("Reads '%s' and '%s' are not a pair" % (read_id, rev_id))
+                yield Read(read_id=read_id, seq=seq, qual=qual, rev=rev, rev_qual=rev_qual, rev_id=rev_id)
+            _add_checksums(checksums, ffile, rfile)
+
+
+def _add_checksums(checksums: Optional[List[int]], *handles: io.TextIOWrapper) -> None:
+    """Add the CRC32 of the bytes each handle has read to 'checksums', for files read through a _RangeReader"""
+    if checksums is None:
+        return
+    for handle in handles: # type: io.TextIOWrapper
+        raw = getattr(handle.buffer, 'raw', None) # type: Any
+        if isinstance(raw, _RangeReader):
+            checksums.append(raw.crc)
 
 
 def read_fastq(fastq: str, pair: Optional[str]=None) -> Tuple[Read]:
     """Read in a FASTQ file, and optionally its pair
     'fastq' the filename for the forward or only FASTQ file
-    'pair' an optional filename for the reverse FASTQ file"""
-    reads = dict() # type: Dict[str, Read]
-    with open(fastq, 'r') as ffile: # type: _io.TextIOWrapper
-        for read in QualityIO.FastqGeneralIterator(ffile): # type: Tuple[str]
-            read_id, seq, qual = read # type: str, str, str
-            reads[read_id] = Read(read_id=read_id, seq=seq, qual=qual)
-    if pair:
-        with open(pair, 'r') as rfile: # type: _io.TextIOWrapper
-            for read in QualityIO.FastqGeneralIterator(rfile): # type: Tuple[str]
-                read_id, seq, qual = read # type: str, str, str
-                reads[read_id].add_reverse(seq=seq, qual=qual)
-    return tuple(reads.values())
+    'pair' an optional filename for the reverse FASTQ file
+
+    This holds every read in memory, use 'iter_fastq' to stream reads instead"""
+    return tuple(iter_fastq(fastq=fastq, pair=pair))
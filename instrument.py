@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Timing, progress, memory, and profiling hooks for BarcSeek"""
+
+import sys
+if sys.version_info.major is not 3 and sys.version_info.minor < 5:
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+import io
+import os
+import time
+import pstats
+import resource
+import threading
+import contextlib
+from typing import Optional, Iterable, Iterator, List, Dict, Callable
+
+
+#   How many functions to list in the text profile report
+PROFILE_LINES = 50 # type: int
+
+
+def peak_rss() -> int:
+    """The peak resident set size of this process, in kilobytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # type: int
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class StageTimer(object):
+
+    """Wall and CPU time spent in the named stages of the pipeline
+    Time a stage with 'with timer.stage(name):', a stage can be entered many times and
+    its times add up. Timings from other timers, such as those of workers, can be added in
+    per_thread [bool]=False     Count the CPU time of the thread running each stage rather than
+                                    of the whole process, for stages that run at the same time
+                                    in different threads; each stage must stay on one thread
+    """
+
+    def __init__(self, per_thread: bool=False) -> None:
+        self._wall = dict() # type: Dict[str, float]
+        self._cpu = dict() # type: Dict[str, float]
+        #   time.thread_time is new in Python 3.7
+        self._clock = getattr(time, 'thread_time', time.process_time) if per_thread else time.process_time # type: Callable[[], float]
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the pipeline
+        name [str]:     The name of the stage
+        """
+        wall, cpu = time.perf_counter(), self._clock() # type: float, float
+        try:
+            yield
+        finally:
+            self._wall[name] = self._wall.get(name, 0.0) + time.perf_counter() - wall
+            self._cpu[name] = self._cpu.get(name, 0.0) + self._clock() - cpu
+
+    def add(self, timings: Dict[str, Dict[str, float]]) -> None:
+        """Add in timings from 'StageTimer.timings'
+        timings [Dict[str, Dict[str, float]]]:  The timings to add
+        """
+        for name, times in timings.items(): # type: str, Dict[str, float]
+            self._wall[name] = self._wall.get(name, 0.0) + times['wall_seconds']
+            self._cpu[name] = self._cpu.get(name, 0.0) + times['cpu_seconds']
+
+    def timings(self) -> Dict[str, Dict[str, float]]:
+        """Get the wall and CPU seconds spent in each stage, as 'wall_seconds' and 'cpu_seconds'"""
+        return {
+            name: {'wall_seconds': round(self._wall[name], 4), 'cpu_seconds': round(self._cpu[name], 4)}
+            for name in self._wall
+        }
+
+    def summary(self) -> str:
+        """Get a table of the time spent in each stage"""
+        lines = ['%-12s %12s %12s' % ('stage', 'wall (s)', 'cpu (s)')] # type: List[str]
+        for name in self._wall: # type: str
+            lines.append('%-12s %12.2f %12.2f' % (name, self._wall[name], self._cpu[name]))
+        return '\n'.join(lines)
+
+
+class Progress(object):
+
+    """A progress line of reads done and reads per second, rewritten in place
+    Nothing is written unless the stream is a terminal
+    """
+
+    def __init__(self, stream: Optional[io.TextIOBase]=None, interval: float=1.0, matched: Optional[Callable[[], int]]=None) -> None:
+        """
+    stream [io.TextIOBase]=None     Where to write the progress, defaults to sys.stderr
+    interval [float]=1.0            The fewest seconds between updates of the line
+    matched [Callable]=None         Optional function returning how many reads the workers have matched so far,
+                                        counting chunks still running; the line is then also rewritten
+                                        every interval between chunks, so that long chunks show progress
+    """
+        self._stream = stream or sys.stderr # type: io.TextIOBase
+        self._enabled = self._stream.isatty() # type: bool
+        self._interval = interval # type: float
+        self._start = time.perf_counter() # type: float
+        self._last = 0.0 # type: float
+        self._reads = 0 # type: int
+        self._resumed = 0 # type: int
+        self._chunks = 0 # type: int
+        self._matched = matched # type: Optional[Callable[[], int]]
+        self._lock = threading.Lock() # type: threading.Lock
+        self._done = threading.Event() # type: threading.Event
+        self._thread = None # type: Optional[threading.Thread]
+        if self._enabled and matched:
+            self._thread = threading.Thread(target=self._tick, daemon=True)
+            self._thread.start()
+
+    def _tick(self) -> None:
+        while not self._done.wait(self._interval):
+            with self._lock:
+                self._last = time.perf_counter()
+                self._write()
+
+    def _write(self, end: str='') -> None:
+        reads = self._reads # type: int
+        if self._matched:
+            #   Workers count their reads before their chunks finish, so the live count is never behind
+            reads = max(reads, self._resumed + self._matched())
+        elapsed = time.perf_counter() - self._start # type: float
+        rate = reads / elapsed if elapsed else 0.0 # type: float
+        self._stream.write('\r%i reads in %i chunks, %.0f reads/sec, %.0fs%s' % (reads, self._chunks, rate, elapsed, end))
+        self._stream.flush()
+
+    def update(self, reads: int, resumed: bool=False) -> None:
+        """Count a finished chunk
+        reads [int]:            How many reads were in the chunk
+        resumed [bool]=False    Was the chunk finished in an earlier run, rather than by a worker
+        """
+        with self._lock:
+            self._reads += reads
+            self._chunks += 1
+            if resumed:
+                self._resumed += reads
+            if self._enabled and time.perf_counter() - self._last >= self._interval:
+                self._last = time.perf_counter()
+                self._write()
+
+    def finish(self) -> None:
+        """Stop rewriting the line and write the final progress line"""
+        self._done.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._enabled:
+            with self._lock:
+                self._write(end='\n')
+
+
+def merge_profiles(profiles: Iterable[str], output_file: str) -> Optional[str]:
+    """Merge cProfile output from the workers into one profile
+    profiles [Iterable[str]]:   The cProfile output files to merge, removed once merged
+    output_file [str]:          Where to write the merged profile, for pstats or snakeviz;
+                                    a text report of the slowest functions is written
+                                    next to it with a '.txt' extension
+
+    Returns the path to the text report, or None if there was nothing to merge
+    """
+    profiles = [profile for profile in profiles if os.path.exists(profile)] # type: List[str]
+    if not profiles:
+        return None
+    merged = pstats.Stats(*profiles) # type: pstats.Stats
+    merged.dump_stats(output_file)
+    report_file = os.path.splitext(output_file)[0] + '.txt' # type: str
+    with open(report_file, 'w') as rfile:
+        merged.stream = rfile
+        merged.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        merged.sort_stats('tottime').print_stats(PROFILE_LINES)
+    for profile in profiles: # type: str
+        os.remove(profile)
+    return report_file
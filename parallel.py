@@ -6,32 +6,51 @@ if sys.version_info.major is not 3 and sys.version_info.minor < 5:
     sys.exit("Please use Python 3.5 or higher for this program")
 
 import os
-import glob
-import dask
-from dask import multiprocessing, delayed
 import logging
 import json
 import sys
+import shutil
 import subprocess
-import shlex
-import re
-from time import sleep
-from partition import partition
-from BarcSeek import extract_barcodes
+import cProfile
+import pstats
+import hashlib
+import time
+import zlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import fastq
+import stats
+import instrument
+from sketch import SpaceSaving, UmiCounter
+from partition import partition, build_classifier, UNDETERMINED
 
 import itertools
-from typing import Optional
+import functools
+from typing import Optional, Iterator
 
-logging.basicConfig(filename='parallel.log', filemode="w", level=logging.DEBUG, format='%(asctime)s %(message)s',
-                    datefmt='%m/%d/%Y %I:%M:%S %p')
 logger = logging.getLogger('barcode-logger')
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-logger.addHandler(ch)
 
 split_file_pattern = 'x12345_filename.fastq'
-
-dask.set_options(get=dask.multiprocessing.get)
+sample_bytes = 64 * 1024
+# streamed batches have no known count, so their names are wide enough to sort in order
+stream_width = 9
+# the run manifest is written next to the output as <forward basename>.manifest.json, at most this often in seconds
+manifest_interval = 1.0
+# without -l, chunks are sized by guided self-scheduling: each chunk is the bytes still to split over guided_parts
+# per worker, so chunks shrink as the run goes on, idle workers take the small ones at the end, and every worker
+# finishes at about the same time; no chunk is smaller than min_chunk_bytes
+guided_parts = 2
+min_chunk_bytes = 16 * 1024 * 1024
+# reads held in memory take about this many times their size in the FASTQ file
+read_overhead = 4
+# the modules a dask.distributed worker needs to partition a chunk
+worker_modules = ('sketch', 'instrument', 'fastq', 'partition', 'stats', 'parallel')
+# the reads matched by every worker of a process pool so far, shared with each worker by _warm_ for the progress line
+reads_matched = None
+# the manager's profiler with -p; workers forked while it is enabled disable their copy in _warm_, since from Python 3.12
+# a process can only enable one profiler, and the copy would otherwise record the worker into a profile never written
+manager_profiler = None
 
 def _fake_partition_(filename: str):
     logger.debug("loading file: %s", filename)
@@ -61,22 +80,11 @@ def _join_output_files_(output_file_dir: str):
     logger.debug("joining output files in dir %s", output_file_dir)
 
 
-def _run_command_(command):
-    process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, bufsize=1)
-    so = []
-    while True:
-        output = process.stdout.readline().decode()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            so.append(output.strip())
-    rc = process.poll()
-    return rc, so
-
-
-def _get_line_count_(fastq_fn:str) -> int:
-    (rc, out) = _run_command_("wc -l %s" % fastq_fn)
-    return int(out[0].split(" ")[0])
+def _bytes_per_line_(fastq_fn: str) -> float:
+    with open(fastq_fn, 'rb') as f:
+        head = f.read(sample_bytes)
+    lines = head.count(b'\n')
+    return len(head) / lines if lines else max(len(head), 1)
 
 
 def _get_dir_fn_(fastq_file: str) -> tuple:
@@ -87,146 +95,515 @@ def _get_dir_fn_(fastq_file: str) -> tuple:
         return "", ""
 
 
-''' creates files of the format x12345_filename.fastq '''
-def _split_fastq_(fastq_fn: str, num_lines: int):
-    (d, fn) = _get_dir_fn_(fastq_fn)
-    logger.debug("chunk file num lines=%i" % num_lines)
-    logger.debug("changing dir to: %s" % d)
-    os.chdir(d)
-    cmd = "split -d -a 5 -l %i --additional-suffix=_%s %s" % (num_lines, fn, fn)
-
-    logger.debug("running command %s" % cmd)
-    (rc, out) = _run_command_(cmd)
-    return rc, out
+''' the memory budget of each worker in bytes: max_memory, or half of the physical memory, split between the workers '''
+def _worker_memory_(max_memory: Optional[int], workers: int) -> int:
+    if not max_memory:
+        try:
+            max_memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+        except (AttributeError, ValueError, OSError):
+            max_memory = 2 * workers * fastq.MAX_BUFFERED
+    return max(max_memory // workers, 1)
 
 
-''' creates files of the format x12345_filename.fastq '''
-def _split_files_(num_lines: int, forward_fastq: str, reverse_fastq: Optional[str] = None):
-    (rc, out) = _split_fastq_(forward_fastq, num_lines)
-    if rc:
-        raise Exception("Error splitting files, error code %s" % rc)
+''' the size of the next chunk under guided self-scheduling, given the bytes still to split '''
+def _guided_size_(remaining: int, workers: int) -> int:
+    return max(min_chunk_bytes, remaining // (guided_parts * workers))
 
-    if reverse_fastq:
-        (rc, out) = _split_fastq_(reverse_fastq, num_lines)
-        if rc:
-            raise Exception("Error splitting files, error code %s" % rc)
 
+''' chunks named x00000, x00001, ... after the lane, as record-aligned byte ranges of the input files, of about num_lines
+    lines or sized for the workers when num_lines is None; streams are one chunk, read in batches by the manager '''
+def _fetch_chunk_files_(num_lines: Optional[int], forward_fastq: str, reverse_fastq: Optional[str] = None,
+                        workers: int = 1, lane: str = '') -> dict:
+    if fastq.is_stream(forward_fastq):
+        chunk_size = 1
+    elif num_lines:
+        chunk_size = max(1, int(num_lines * _bytes_per_line_(forward_fastq)))
+        logger.debug("chunk size %i bytes for %i lines" % (chunk_size, num_lines))
+    else:
+        chunk_size = functools.partial(_guided_size_, workers=workers)
+        logger.debug("guided chunk sizes for %i workers" % workers)
+    ranges = fastq.chunk_fastq(forward_fastq, chunk_size, reverse_fastq)
+    logger.debug("found %i chunks in %s" % (len(ranges), forward_fastq))
 
-''' files in the format x12345_filename.fastq '''
-def _fetch_chunk_files_(num_lines: int, forward_fastq: str, reverse_fastq: Optional[str] = None) -> dict:
-    (d, f_fn) = _get_dir_fn_(forward_fastq)
-
-    logger.debug("fetching chunk files, changing dir to %s" % d)
-    os.chdir(d)
-
+    width = max(5, len(str(len(ranges) - 1)))
     master_dict = {}
-
-    _split_files_(num_lines, forward_fastq, reverse_fastq)
-    logger.debug("fetching new file names")
-
-    f_regex = 'x*_' + f_fn
-    logger.debug("looking for files of pattern %s" % f_regex)
-    f_files = glob.glob(f_regex)
-
-    logger.debug("found %i files" % len(f_files))
-
-    f_dict = {re.search('x(\d+)', fn).group(0): fn for fn in f_files}
-
-    prefixes = list(f_dict.keys())
-    prefixes.sort()
-    logger.debug("num prefixes: %i" % len(prefixes))
-
-    if (reverse_fastq):
-        (d, r_fn) = _get_dir_fn_(reverse_fastq)
-        r_files = glob.glob('x*_' + r_fn)
-        r_files.sort()
-        r_dict = {re.search('x(\d+)', fn).group(0): fn for fn in r_files}
-        for p in prefixes:
-            f_file = os.path.join(d, f_dict[p])
-            r_file = os.path.join(d, r_dict[p])
-            master_dict[p] = {'f_input': f_file, 'r_input': r_file}
-    else:
-        for p in prefixes:
-            f_file = os.path.join(d, f_dict[p])
-            master_dict[p] = {'f_input': f_file, 'r_input': None}
+    for i, (f_range, r_range) in enumerate(ranges):
+        p = lane + 'x%0*d' % (width, i)
+        master_dict[p] = {'f_input': forward_fastq, 'r_input': reverse_fastq or None,
+                          'f_range': f_range, 'r_range': r_range}
 
     return master_dict
 
 
-def _join_output_(sample_dict:dict, forward_fastq:str, reverse_fastq: Optional[str] = None):
-    (d, fn) = _get_dir_fn_(forward_fastq)
-
-    os.chdir(d)
-    print("changed to dir %s" % os.getcwd())
-
-    for sample in sample_dict.keys():
-        multi_pattern = sample + "_" + "fwd" + "_x*_" + fn
-        output_file = sample + "_fwd_" + fn
-        print("joining output for %s" % sample)
-        cmd = "cat " + multi_pattern + " > " +  output_file
-        rmc = "rm -f " + multi_pattern
-        rc = subprocess.call(cmd, shell=True)
-        rc2 = subprocess.call(rmc, shell=True)
-        if rc:
-            raise Exception("Error joining output files"
-                            )
-
-def _sanity_checks_(num_lines:int, forward_fastq:str, reverse_fastq: Optional[str] = None):
-    logger.debug("sanity checks num_lines %i, forward_fastq %s, reverse %s" % (num_lines, forward_fastq, reverse_fastq))
-    (fdir, ffn) = _get_dir_fn_(forward_fastq)
-    (rdir, rfn) = _get_dir_fn_(reverse_fastq)
-    if rdir and not (fdir == rdir):
-        raise Exception("forward fastq and reverse fastq must be in same directory: %s   %s" % forward_fastq,
-                        reverse_fastq)
-    file_lines = _get_line_count_(forward_fastq)
-    if file_lines % 4 or num_lines % 4:
-        raise Exception("fastq file size, and split file size must both be a multiple of 4, you gave file: %i, split: %i"
-                % (file_lines, num_lines))
+''' copies one file onto the end of another in the kernel where possible: with copy_file_range, then with
+    sendfile where copy_file_range is missing or fails (such as across filesystems), then through userspace '''
+def _copy_(source, target):
+    size = os.fstat(source.fileno()).st_size
+    copied = 0
+    copy_range = getattr(os, 'copy_file_range', None)
+    while copied < size:
+        try:
+            if copy_range:
+                n = copy_range(source.fileno(), target.fileno(), size - copied)
+            else:
+                n = os.sendfile(target.fileno(), source.fileno(), copied, size - copied)
+        except OSError:
+            n = 0
+        if not n:
+            if not copy_range:
+                break
+            copy_range = None
+            continue
+        copied += n
+    if copied < size:
+        source.seek(copied)
+        shutil.copyfileobj(source, target)
+
+
+''' joins chunk outputs in chunk order into a temporary file, which replaces output_file once complete;
+    when resuming, an output whose chunk files were already partly removed was joined before '''
+def _merge_(output_file: str, chunk_files: list, resume: bool = False):
+    if resume and os.path.exists(output_file) and not all(map(os.path.exists, chunk_files)):
+        logger.debug("already joined %s" % output_file)
+        for chunk_file in filter(os.path.exists, chunk_files):
+            os.remove(chunk_file)
+        return
+    logger.debug("joining %i files into %s" % (len(chunk_files), output_file))
+    temp_file = output_file + '.tmp'
+    try:
+        with open(temp_file, 'wb', buffering=0) as target:
+            for chunk_file in chunk_files:
+                with open(chunk_file, 'rb', buffering=0) as source:
+                    _copy_(source, target)
+        os.replace(temp_file, output_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    for chunk_file in chunk_files:
+        os.remove(chunk_file)
+
+
+''' one output file per sample, for forward and reverse, named after forward_fastq and merged from the chunks of every lane
+    in order, for different samples in parallel '''
+def _join_output_(sample_dict:dict, prefixes:list, output_dir:str, forward_fastq:str, reverse_fastq: Optional[str] = None,
+                  compression: Optional[str] = None, threads: Optional[int] = None, resume: bool = False):
+    d = output_dir
+    fn = fastq.output_basename(forward_fastq, compression)
+    directions = ('fwd', 'rev') if reverse_fastq else ('fwd',)
+
+    jobs = []
+    outputs = {}
+    for sample in itertools.chain(sample_dict.keys(), (UNDETERMINED,)):
+        outputs[sample] = []
+        for direction in directions:
+            output_file = os.path.join(d, "%s_%s_%s" % (sample, direction, fn))
+            chunk_files = [os.path.join(d, "%s_%s_%s_%s" % (sample, direction, p, fn)) for p in sorted(prefixes)]
+            jobs.append((output_file, chunk_files))
+            outputs[sample].append(output_file)
+
+    logger.debug("joining output for %i samples" % len(sample_dict))
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+        for _ in executor.map(lambda job: _merge_(*job, resume=resume), jobs):
+            pass
+    return outputs
+
+
+def _sanity_checks_(num_lines:Optional[int], forward_fastq:str, reverse_fastq: Optional[str] = None):
+    logger.debug("sanity checks num_lines %s, forward_fastq %s, reverse %s" % (num_lines, forward_fastq, reverse_fastq))
+    if forward_fastq == reverse_fastq == fastq.STDIN:
+        raise Exception("forward fastq and reverse fastq cannot both be read from standard input")
+    if num_lines and num_lines % 4:
+        raise Exception("split file size must be a multiple of 4, you gave split: %i" % num_lines)
 
 
 def _dump_dict_(master_dict:dict):
     for p in master_dict.keys():
         f_f = master_dict[p]["f_input"]
         r_f = master_dict[p]["r_input"]
-        logger.debug("prefix %s, forward: %s, reverse %s" % (p, f_f, r_f))
-
-
-def _partition_(barcodes:dict, forward_fn:str, reverse_fn: Optional[str] = None):
-    return partition(barcodes, forward_fn, reverse_fn)
-
-
-def _reduce_(results:list):
-    sleep(3)
-
-
-
-
-def parallelize(sample_dict:dict, num_lines:int, forward_fastq:str, reverse_fastq:Optional[str] = None):
-    orig_home = os.getcwd()
-
-    _sanity_checks_(num_lines, forward_fastq, reverse_fastq)
-    master_dict  = _fetch_chunk_files_(num_lines, forward_fastq, reverse_fastq)
-    logger.debug(json.dumps(master_dict))
-    logger.debug("iterating over partition calls")
-    results = []
-
+        logger.debug("prefix %s, forward: %s %s, reverse %s %s" % (p, f_f, master_dict[p]["f_range"], r_f,
+                                                                   master_dict[p]["r_range"]))
+
+
+''' partitions one chunk, under cProfile when profile_dir is given, writing the profile of it and its reading and
+    writing threads there as <prefix>.prof; the chunk is checksummed for the run manifest if there is one '''
+def _partition_(barcodes:dict, prefix:str, chunk:dict, error_rate: Optional[int] = None, offset: Optional[int] = None,
+                 compression: Optional[str] = None, matcher: Optional[str] = None, layouts: Optional[dict] = None,
+                 shift: Optional[int] = None, profile_dir: Optional[str] = None, output_dir: Optional[str] = None,
+                 dual_index: bool = False, max_buffered: Optional[int] = None, extract_umis: bool = False,
+                 output_name: Optional[str] = None, checksum: bool = True):
+    profiler = cProfile.Profile() if profile_dir else None
+    profilers = [] if profiler else None
+    if profiler:
+        profiler.enable()
+    try:
+        # chunks read by byte range are checksummed from the bytes their reads are parsed from
+        checksums = [] if checksum and chunk.get('reads') is None else None
+        counts = partition(barcodes, chunk['f_input'], chunk['r_input'], error_rate=error_rate, offset=offset,
+                           forward_range=chunk['f_range'], reverse_range=chunk['r_range'], prefix=prefix,
+                           compression=compression, reads=chunk.get('reads'), matcher=matcher,
+                           layouts=layouts, shift=shift, output_directory=output_dir, dual_index=dual_index,
+                           max_buffered=max_buffered, extract_umis=extract_umis, output_name=output_name,
+                           profilers=profilers, progress=_count_reads_ if reads_matched is not None else None,
+                           checksums=checksums)
+        counts['checksum'] = checksums if checksums is not None else _checksum_(chunk) if checksum else None
+        return prefix, counts
+    finally:
+        if profiler:
+            profiler.disable()
+            pstats.Stats(profiler, *profilers).dump_stats(os.path.join(profile_dir, prefix + '.prof'))
+
+
+''' batches of num_lines lines, or of about batch_bytes of sequence and quality when num_lines is None '''
+def _batches_(reads: Iterator, num_lines: Optional[int], batch_bytes: int) -> Iterator[list]:
+    if num_lines:
+        while True:
+            batch = list(itertools.islice(reads, max(1, num_lines // 4)))
+            if not batch:
+                return
+            yield batch
+    batch, size = [], 0
+    for read in reads:
+        batch.append(read)
+        size += 2 * (len(read.forward) + len(read.reverse or ''))
+        if size >= batch_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+''' chunks that cannot be read by byte range are read here and fed to the workers in batches, named after their lane '''
+def _tasks_(master_dict: dict, num_lines: Optional[int], batch_bytes: int) -> Iterator[tuple]:
     for p in sorted(master_dict):
-        f_file = master_dict[p]['f_input']
-        r_file = master_dict[p]['r_input']
-        logger.debug("calling partition")
-        result = dask.delayed(_partition_)(sample_dict, f_file, r_file)
-        results.append(result)
-
-    logger.debug("calling reduce")
-    the_job = dask.delayed(_reduce_)(results)
-    the_job.compute(num_workers=4)
-
-    join_out = _join_output_(sample_dict, forward_fastq, reverse_fastq)
-
-    #the_job.visualize()
+        chunk = master_dict[p]
+        if chunk['f_range'] is not None:
+            yield p, chunk
+            continue
+        logger.debug("streaming %s in batches of %s" % (chunk['f_input'], '%i lines' % num_lines if num_lines
+                                                        else '%i bytes' % batch_bytes))
+        reads = fastq.iter_fastq(chunk['f_input'], chunk['r_input'])
+        for i, batch in enumerate(_batches_(reads, num_lines, batch_bytes)):
+            yield p[:p.index('x')] + 'x%0*d' % (stream_width, i), dict(chunk, reads=batch)
+
+
+''' identifies an input file by its size and a hash of its first and last bytes '''
+def _fingerprint_(filename: Optional[str]) -> Optional[dict]:
+    if not filename:
+        return None
+    size = os.path.getsize(filename)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        digest.update(f.read(sample_bytes))
+        f.seek(max(size - sample_bytes, 0))
+        digest.update(f.read(sample_bytes))
+    return {'path': filename, 'size': size, 'sha1': digest.hexdigest()}
+
+
+''' crc32 of the read IDs in a batch streamed from a file, whose contents the run's input fingerprints already vouch
+    for; the reads themselves are not written out again to checksum them '''
+def _checksum_(chunk: dict) -> int:
+    return zlib.crc32('\n'.join(read.read_id for read in chunk['reads']).encode())
+
+
+''' the run manifest: what the run was given, its chunks, and the checksum of every finished chunk, whose counts are kept
+    in a file of their own so that the manifest does not grow with the samples and UMIs of every chunk '''
+def _new_manifest_(parameters: dict, lanes: list, master_dict: dict) -> dict:
+    return {
+        'parameters': hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest(),
+        'inputs': [_fingerprint_(fastq_file) for lane in lanes for fastq_file in lane],
+        'chunks': master_dict,
+        'done': {}
+    }
+
+
+''' loads the manifest of an earlier run, if it was given the same inputs and parameters '''
+def _load_manifest_(manifest_file: str, parameters: dict, lanes: list) -> Optional[dict]:
+    if not os.path.exists(manifest_file):
+        logger.debug("no manifest %s to resume from, starting over" % manifest_file)
+        return None
+    with open(manifest_file) as mfile:
+        manifest = json.load(mfile)
+    expected = _new_manifest_(parameters, lanes, {})
+    for key in ('parameters', 'inputs'):
+        if manifest[key] != expected[key]:
+            raise Exception("cannot resume from %s, the %s have changed since it was written" % (manifest_file, key))
+    for chunk in manifest['chunks'].values():
+        for key in ('f_range', 'r_range'):
+            chunk[key] = tuple(chunk[key]) if chunk[key] else None
+    logger.debug("resuming from %s with %i chunks done" % (manifest_file, len(manifest['done'])))
+    return manifest
+
+
+''' writes the manifest to a temporary file, which replaces the manifest once it is on disk '''
+def _save_manifest_(manifest_file: Optional[str], manifest: dict):
+    if not manifest_file:
+        return
+    temp_file = manifest_file + '.tmp'
+    with open(temp_file, 'w') as mfile:
+        json.dump(manifest, mfile)
+        mfile.flush()
+        os.fsync(mfile.fileno())
+    os.replace(temp_file, manifest_file)
+
+
+''' writes the counts of a finished chunk to <prefix>.json in counts_dir, once, before the manifest records it as done '''
+def _save_counts_(counts_dir: str, prefix: str, counts: dict):
+    os.makedirs(counts_dir, exist_ok=True)
+    counts_file = os.path.join(counts_dir, prefix + '.json')
+    with open(counts_file + '.tmp', 'w') as cfile:
+        json.dump(_dump_counts_(counts), cfile)
+        cfile.flush()
+        os.fsync(cfile.fileno())
+    os.replace(counts_file + '.tmp', counts_file)
+
+
+def _dump_counts_(counts: dict) -> dict:
+    return dict(counts, unknown_barcodes=counts['unknown_barcodes'].state(),
+                umis={sample: umis.state() for (sample, umis) in counts['umis'].items()})
+
+
+def _load_counts_(counts: dict) -> dict:
+    return dict(counts, unknown_barcodes=SpaceSaving.from_state(counts['unknown_barcodes']),
+                umis={sample: UmiCounter.from_state(umis) for (sample, umis) in counts['umis'].items()})
+
+
+''' the counts of a chunk finished in an earlier run, if each of its outputs is still there or was already joined;
+    the inputs are vouched for by their fingerprints when the manifest is loaded, so finished chunks are not read again '''
+def _is_done_(done: Optional[dict], prefix: str, counts_dir: str) -> Optional[dict]:
+    counts_file = os.path.join(counts_dir, prefix + '.json')
+    if not done or not os.path.exists(counts_file):
+        return None
+    with open(counts_file) as cfile:
+        counts = json.load(cfile)
+    for sample, files in counts['outputs'].items():
+        for direction, chunk_file in zip(('fwd', 'rev'), files):
+            if not chunk_file or os.path.exists(chunk_file):
+                continue
+            (d, fn) = _get_dir_fn_(chunk_file)
+            fn = fn[len("%s_%s_%s_" % (sample, direction, prefix)):]
+            if not os.path.exists(os.path.join(d, "%s_%s_%s" % (sample, direction, fn))):
+                return None
+    return _load_counts_(counts)
+
+
+''' passes on the tasks that still need partitioning, adding the counts of chunks done in an earlier run to results '''
+def _resume_tasks_(tasks: Iterator[tuple], manifest: dict, counts_dir: Optional[str], results: list,
+                   progress) -> Iterator[tuple]:
+    for p, chunk in tasks:
+        counts = _is_done_(manifest['done'].get(p), p, counts_dir) if counts_dir else None
+        if counts:
+            results.append((p, counts))
+            progress.update(counts['reads'], resumed=True)
+            continue
+        yield p, chunk
+
+
+''' runs tasks on the pool with at most max_pending in flight, yielding results as they finish '''
+def _bounded_map_(executor, fn, tasks: Iterator[tuple], max_pending: int) -> Iterator:
+    pending = set()
+    for task in tasks:
+        pending.add(executor.submit(fn, *task))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in pending:
+        yield future.result()
+
+
+def _reduce_(results:list) -> tuple:
+    logger.debug("reducing %i results" % len(results))
+    prefixes = sorted(p for (p, counts) in results)
+    return prefixes, stats.merge_counts(counts for (p, counts) in results)
+
+
+''' builds the classifier for a run in a worker before its first chunk arrives, see partition.build_classifier;
+    a process pool also shares its counter of matched reads '''
+def _warm_(barcodes: dict, options: dict, matched=None):
+    global reads_matched
+    reads_matched = matched
+    if manager_profiler is not None:
+        manager_profiler.disable()
+    build_classifier(barcodes, **options)
+
+
+''' adds a batch of matched reads to the counter shared by the workers '''
+def _count_reads_(reads: int):
+    with reads_matched.get_lock():
+        reads_matched.value += reads
+
+
+''' a process pool, or an executor on the dask.distributed cluster at the scheduler address, and how many tasks it runs at once; 'local' starts a LocalCluster of one single-threaded worker per thread;
+    warm is a function every worker runs first with warm_args '''
+@contextlib.contextmanager
+def _executor_(scheduler: Optional[str], threads: int, warm=None, warm_args: tuple = ()):
+    if not scheduler:
+        with ProcessPoolExecutor(max_workers=threads, initializer=warm, initargs=warm_args) as executor:
+            yield executor, threads
+        return
+    try:
+        from distributed import Client, LocalCluster
+    except ImportError as error:
+        sys.exit("Please install " + error.name)
+    cluster = LocalCluster(n_workers=threads, threads_per_worker=1, processes=True) if scheduler == 'local' else None
+    try:
+        with Client(cluster or scheduler) as client:
+            # workers import the partitioning code by name, so it is sent to them rather than installed on every node
+            for module in worker_modules:
+                client.upload_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + '.py'), load=False)
+            if warm:
+                client.run(warm, *warm_args)
+            slots = sum(client.nthreads().values()) or threads
+            logger.debug("submitting chunks to %s with %i worker threads" % (client.scheduler.address, slots))
+            # tasks are not hashed by their arguments, which can be whole batches of reads
+            yield client.get_executor(pure=False), slots
+    finally:
+        if cluster:
+            cluster.close()
+
+
+''' logging to parallel.log and the terminal is set up by the manager when a run starts, not when workers import this module '''
+def _configure_logging_():
+    if logger.handlers:
+        return
+    logging.basicConfig(filename='parallel.log', filemode="w", level=logging.DEBUG, format='%(asctime)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+
+def parallelize(sample_dict:dict, num_lines:Optional[int], forward_fastq:Optional[str], reverse_fastq:Optional[str] = None,
+                error_rate: Optional[int] = None, offset: Optional[int] = None, compression: Optional[str] = None,
+                threads: Optional[int] = None, matcher: Optional[str] = None, layouts: Optional[dict] = None,
+                shift: Optional[int] = None, profile: bool = False, resume: bool = False,
+                output_dir: Optional[str] = None, dual_index: bool = False, scheduler: Optional[str] = None,
+                max_memory: Optional[int] = None, extract_umis: bool = False, lanes: Optional[list] = None,
+                output_name: Optional[str] = None):
+    _configure_logging_()
+    # several lanes, as (forward, reverse) pairs, are partitioned together into one output per sample,
+    # named output_name or after the first lane; a single pair of fastqs is a run of one lane
+    lanes = [tuple(os.path.abspath(f) if f and f != fastq.STDIN else f or None for f in lane)
+             for lane in lanes or [(forward_fastq, reverse_fastq)]]
+    (forward_fastq, reverse_fastq) = lanes[0]
+    if any(bool(r) != bool(reverse_fastq) for (f, r) in lanes):
+        raise Exception("either every lane or none must have a reverse fastq: %s" % json.dumps(lanes))
+    # output goes next to the forward fastq by default, or in the working directory when it is standard input
+    d = os.path.abspath(output_dir or os.path.dirname(os.path.abspath(forward_fastq)))
+    fn = fastq.output_basename(output_name or forward_fastq)
+    os.makedirs(d, exist_ok=True)
+    streaming = any(map(fastq.is_stream, filter(None, itertools.chain.from_iterable(lanes))))
+    timer = instrument.StageTimer()
+    profile_dir = os.path.join(d, 'profile') if profile else None
+    global manager_profiler
+    profiler = manager_profiler = cProfile.Profile() if profile else None
+    if profiler:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.enable()
+
+    with timer.stage('total'):
+        for (f, r) in lanes:
+            _sanity_checks_(num_lines, f, r)
+        if sum(f == fastq.STDIN for f in itertools.chain.from_iterable(lanes)) > 1:
+            raise Exception("only one fastq can be read from standard input")
+        # every run keeps a manifest of its finished chunks, so that it can be resumed if it is stopped;
+        # streams cannot be read again, so they are neither resumed nor given a manifest
+        if streaming and resume:
+            raise Exception("cannot resume a run reading from a stream: %s" % json.dumps(lanes))
+        manifest_file = None if streaming else os.path.join(d, fn + '.manifest.json')
+        counts_dir = None if streaming else os.path.join(d, fn + '.manifest.counts')
+        parameters = dict(sample_dict=sample_dict, num_lines=num_lines, error_rate=error_rate, offset=offset,
+                          compression=compression, matcher=matcher, layouts=layouts, shift=shift, dual_index=dual_index,
+                          extract_umis=extract_umis)
+        manifest = _load_manifest_(manifest_file, parameters, lanes) if resume else None
+        threads = threads or os.cpu_count() or 1
+        # chunks are byte ranges of the inputs, so on a cluster the inputs and output directory must be on a
+        # filesystem every node shares; workers return their counts and output filenames, never reads.
+        # The executor starts before chunking, so that chunks are sized for however many workers it has,
+        # and every worker builds the barcode index once, for the chunks of all the lanes
+        options = dict(error_rate=error_rate, offset=offset, matcher=matcher, layouts=layouts, shift=shift,
+                       dual_index=dual_index, umis=extract_umis)
+        # workers in a process pool count the reads they match in a shared counter, so the progress line moves
+        # while long chunks run; dask workers cannot share one, and their progress moves as chunks finish
+        matched = None if scheduler else multiprocessing.Value('q', 0)
+        warm_args = (sample_dict, options) if matched is None else (sample_dict, options, matched)
+        with _executor_(scheduler, threads, _warm_, warm_args) as (executor, slots):
+            memory = _worker_memory_(max_memory, slots)
+            with timer.stage('chunking'):
+                if manifest:
+                    master_dict = manifest['chunks']
+                else:
+                    master_dict = {}
+                    for i, (f, r) in enumerate(lanes):
+                        master_dict.update(_fetch_chunk_files_(num_lines, f, r, slots, 'L%03d' % (i + 1)
+                                                               if len(lanes) > 1 else ''))
+                    manifest = {'done': {}} if streaming else _new_manifest_(parameters, lanes, master_dict)
+                    _save_manifest_(manifest_file, manifest)
+            logger.debug(json.dumps(master_dict))
+            logger.debug("iterating over partition calls with %i workers, %i bytes of memory each" % (slots, memory))
+
+            progress = instrument.Progress(matched=None if matched is None else (lambda: matched.value))
+            results = []
+            saved = time.monotonic()
+            # a worker buffers at most half its memory of output, the rest is for the reads it has been sent
+            worker = functools.partial(_partition_, sample_dict, error_rate=error_rate, offset=offset,
+                                       compression=compression, matcher=matcher, layouts=layouts, shift=shift,
+                                       profile_dir=profile_dir, output_dir=d, dual_index=dual_index,
+                                       max_buffered=min(memory // 2, fastq.MAX_BUFFERED), extract_umis=extract_umis,
+                                       output_name=fn, checksum=manifest_file is not None)
+            batches = _tasks_(master_dict, num_lines, memory // (6 * read_overhead))
+            tasks = _resume_tasks_(batches, manifest, counts_dir, results, progress)
+            # saves are throttled while chunks finish, but the manifest is always saved when the loop ends,
+            # so chunks that finished before an error or an interrupt are not partitioned again on resuming
+            try:
+                for result in _bounded_map_(executor, worker, tasks, 2 * slots):
+                    results.append(result)
+                    progress.update(result[1]['reads'])
+                    (p, counts) = result
+                    if counts_dir:
+                        _save_counts_(counts_dir, p, counts)
+                        manifest['done'][p] = {'checksum': counts['checksum']}
+                    if time.monotonic() - saved >= manifest_interval:
+                        _save_manifest_(manifest_file, manifest)
+                        saved = time.monotonic()
+            finally:
+                _save_manifest_(manifest_file, manifest)
+                progress.finish()
+
+        logger.debug("calling reduce")
+        prefixes, report = _reduce_(results)
+
+        with timer.stage('merging'):
+            outputs = _join_output_(sample_dict, prefixes, d, fn, reverse_fastq, compression, threads, resume)
+
+        report.update(chunks=len(prefixes), forward_fastq=forward_fastq, reverse_fastq=reverse_fastq, lanes=lanes,
+                      error_rate=error_rate, outputs=outputs)
+        with timer.stage('reporting'):
+            logger.debug("writing plot %s" % stats.stats_barc(report, d))
+
+    # the workers' stages are summed over every worker, the manager's are its own
+    timer.add(report['timings'])
+    report.update(timings=timer.timings(), peak_rss_kb=instrument.peak_rss())
+    logger.debug("time spent in each stage:\n%s" % timer.summary())
+    logger.debug("peak RSS of each worker in KB: %s" % json.dumps(report['workers']))
+    if profiler:
+        profiler.disable()
+        manager_profiler = None
+        profiler.dump_stats(os.path.join(profile_dir, 'manager.prof'))
+        profiles = [os.path.join(profile_dir, name) for name in os.listdir(profile_dir) if name.endswith('.prof')]
+        report['profile'] = instrument.merge_profiles(profiles, os.path.join(d, 'profile.prof'))
+        os.rmdir(profile_dir)
+        logger.debug("writing profile %s" % report['profile'])
+    logger.debug("writing report %s" % stats.write_report(report, d))
+    if manifest_file:
+        os.remove(manifest_file)
+        shutil.rmtree(counts_dir, ignore_errors=True)
+    return report
 
 
 def main():
+    from BarcSeek import extract_barcodes
     try:
         #_run_command_("rm -f /home/jcabraham/python-projects/Barcode_Partitioning/test.cases/*x*")
         sample_file = '/home/jcabraham/python-projects/Barcode_Partitioning/new.sample_sheet.txt'
@@ -8,9 +8,14 @@ if sys.version_info.major is not 3 and sys.version_info.minor < 5:
 
 
 import os
+import re
+import json
+import queue
+import cProfile
 import itertools
-from copy import deepcopy
-from typing import Optional, Union, Tuple, List, Dict
+import functools
+import threading
+from typing import Optional, Union, Tuple, List, Dict, Set, Iterable, Iterator, Callable, NamedTuple, Any
 
 try:
     import fastq
@@ -18,9 +23,29 @@ except ImportError:
     sys.exit("Please leave this module in its directory to load the fastq module")
 
 try:
-    import regex
-except ImportError as error:
-    sys.exit("Please install " + error.name)
+    import sketch
+    import instrument
+except ImportError:
+    sys.exit("Please leave this module in its directory to load the sketch and instrument modules")
+
+
+#   Reads that match no sample, or several equally well, are written out under this name
+UNDETERMINED = 'Undetermined' # type: str
+#   How many of the most common unknown barcodes to keep track of
+SKETCH_SIZE = 1000 # type: int
+#   Ways to match fixed-length barcodes at an offset: a table of every variant of each
+#   barcode or a NumPy distance matrix over a batch of reads
+MATCHERS = ('index', 'matrix') # type: Tuple[str, ...]
+#   How many reads are classified at a time
+BATCH_SIZE = 4096 # type: int
+#   How many batches may wait between the reading, matching, and writing threads of 'partition'
+PIPELINE_DEPTH = 4 # type: int
+#   How often, in seconds, a thread waiting on a full or empty queue checks whether the others have stopped
+PIPELINE_POLL = 0.1 # type: float
+#   Marks the end of the batches on a queue
+_END = object() # type: object
+#   The classifier this process built last, by its barcodes and options, see 'build_classifier'
+_CLASSIFIERS = dict() # type: Dict[str, Tuple[Callable, Dict[str, List[Placement]]]]
 
 
 IUPAC_CODES = { # type: Dict[str, str]
@@ -36,6 +61,60 @@ IUPAC_CODES = { # type: Dict[str, str]
     'V': 'ACG'
 }
 
+#   Segments of a read layout: sample barcode, UMI, spacer, and template
+LAYOUT_SEGMENTS = 'BUST' # type: str
+
+#   One segment of a read layout, 'length' is None for a '+' segment running to the end of the read
+Segment = NamedTuple('Segment', [ # type: type
+    ('kind', str),
+    ('length', Optional[int])
+])
+
+#   Where a barcode sits in a read: its sequence with 'N's for UMIs and spacers, and its first base
+Placement = NamedTuple('Placement', [ # type: type
+    ('barcode', str),
+    ('start', int)
+])
+
+#   The outcome of classifying one read against every sample
+Assignment = NamedTuple('Assignment', [ # type: type
+    ('sample', Optional[str]),
+    ('read', Optional[fastq.Read]),
+    ('errors', Optional[int]),
+    ('ambiguous', bool),
+    ('hopped', Optional[Tuple[str, str]])
+])
+#   Only dual-indexed reads whose barcodes resolve to a pair no sample has are 'hopped'
+Assignment.__new__.__defaults__ = (None,)
+
+
+def expand_iupac(barcode):
+    '''
+    Expand IUPAC codes, i.e. turn 'AY' to ['AC', 'AT'], removes 'N's
+    '''
+    barcode = barcode.upper()
+    if all((i in 'ACGTN' for i in set(barcode))):
+        return barcode.replace('N','')
+    else:
+        pos = next(i for i, base in enumerate(barcode) if base in IUPAC_CODES)
+        code = barcode[pos]
+        return (expand_iupac(barcode.replace(code, i, 1)) for i in IUPAC_CODES[code])
+
+
+def unpack(collection):
+    '''
+    Unpack a series of nested lists, sets, or tuples
+    '''
+    result = [] # type: List
+    for item in collection:
+        # if isinstance(item, (list, set, tuple)):
+        if hasattr(item, '__iter__') and not isinstance(item, str):
+            result.extend(unpack(collection=item))
+        else:
+            result.append(item)
+    return result
+
+
 def fix_iupac(barcode: str) -> str:
     """Remove IUPAC codes from the barcode sequence, 'N's will remain
     barcode [str]   The barcode sequence to remove IUPAC codes from
@@ -47,71 +126,930 @@ def fix_iupac(barcode: str) -> str:
     return new_barcode
 
 
-def barcode_to_regex(barcode: str, error_rate: Optional[int]=None):
-    """Convert a barcode string to a regex pattern
+def barcode_to_regex(barcode: str, error_rate: Optional[int]=None, best: bool=False):
+    """Convert a barcode string to a regex pattern, with a group for each run of barcode bases and
+    a UMI group named 'umi' for each run of 'N's, wherever it is in the barcode
     barcode [str]           The barcode string to turn into a regex
-    error_rate [int]=None   The error rate"""
+    error_rate [int]=None   The error rate
+    best [bool]=False       Search for the match with the fewest errors rather than the first one"""
+    #   regex is only imported when barcodes are searched for, so lookups at an offset start faster
+    try:
+        import regex
+    except ImportError as error:
+        sys.exit("Please install " + error.name)
     pattern = '' # type: str
-    umi = regex.findall(r'(N+)', barcode, regex.IGNORECASE) # type: List[str]
-    umi_lengths = tuple(map(len, umi)) # type: Tuple[int]
-    filtered_barcode = filter(None, barcode.upper().split('N')) # type: filter
-    for index, subpattern in enumerate(filtered_barcode): # type: int, str
-        barcode_pattern = '(' + subpattern + ')' # type: str
-        if error_rate:
-            barcode_pattern += '{e<=' + str(error_rate) + '}'
-        pattern += barcode_pattern
-        try:
-            umi_pattern = '(' + ''.join(itertools.repeat('[ACGT]', umi_lengths[index])) + ')' # type: str
-        except IndexError:
-            break
+    #   Runs of bases and of 'N's become groups in the barcode's own order, the 'N's as UMI groups named by their place
+    for index, run in enumerate(regex.findall(r'N+|[^N]+', barcode.upper())): # type: int, str
+        if run[0] == 'N':
+            subpattern = '(?P<umi%i>' % index + ''.join(itertools.repeat('[ACGT]', len(run))) + ')' # type: str
         else:
-            if error_rate:
-                umi_pattern += '{e<=' + str(error_rate) + '}'
-            pattern += umi_pattern
-    find_barcode = regex.compile(r'%s' % pattern, regex.ENHANCEMATCH)
+            subpattern = '(' + run + ')'
+        if error_rate:
+            subpattern += '{e<=' + str(error_rate) + '}'
+        pattern += subpattern
+    find_barcode = regex.compile(r'%s' % pattern, regex.BESTMATCH if best else regex.ENHANCEMATCH)
     return find_barcode
 
 
+def compile_barcodes(barcodes: Dict[str, List[str]], error_rate: Optional[int]=None) -> Dict[str, Tuple]:
+    """Compile the barcodes for every sample into regex patterns once
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    error_rate [int]=None               The error rate
+    """
+    patterns = dict() # type: Dict[str, Tuple[_regex.Pattern]]
+    for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+        regexes = tuple(barcode_to_regex(barcode, error_rate) for barcode in filter(None, barcode_list)) # type: Tuple[_regex.Pattern]
+        if len(regexes) not in (1, 2):
+            raise ValueError("There only be one or two barcodes")
+        patterns[sample_name] = regexes
+    return patterns
+
+
+def parse_layout(layout: str) -> List[Tuple[Segment, ...]]:
+    """Parse a read layout into its segments, one tuple of segments per read
+    layout [str]:   A read layout such as '6B8U4S+T', made of lengths and segment types,
+                        'B' for the sample barcode, 'U' for a UMI, 'S' for a spacer, and 'T'
+                        for the template; a '+' length runs to the end of the read and may
+                        only be given last. Layouts for the forward and reverse reads are
+                        separated by a ',', a single layout is used for both
+    """
+    reads = list() # type: List[Tuple[Segment, ...]]
+    for read_layout in layout.upper().replace(' ', '').split(','): # type: str
+        tokens = re.findall(r'(\d+|\+)([A-Z])', read_layout) # type: List[Tuple[str, str]]
+        if ''.join(length + kind for length, kind in tokens) != read_layout or not tokens:
+            raise ValueError("Cannot parse read layout '%s'" % layout)
+        segments = list() # type: List[Segment]
+        for length, kind in tokens: # type: str, str
+            if kind not in LAYOUT_SEGMENTS:
+                raise ValueError("Unknown segment '%s' in read layout '%s', must be one of %s" % (kind, layout, LAYOUT_SEGMENTS))
+            if segments and segments[-1].length is None:
+                raise ValueError("Only the last segment of read layout '%s' can be '+'" % layout)
+            segments.append(Segment(kind=kind, length=None if length == '+' else int(length)))
+        reads.append(tuple(segments))
+    if len(reads) > 2:
+        raise ValueError("Read layout '%s' has more than two reads" % layout)
+    return reads
+
+
+def place_barcode(barcode: str, segments: Tuple[Segment, ...]) -> Placement:
+    """Place a barcode in the layout of a read
+    barcode [str]:                  The barcode sequence, as long as the layout's 'B' segments
+    segments [Tuple[Segment, ...]]: The layout of the read from 'parse_layout'
+
+    The placed barcode runs from the first 'B' segment to the end of the last 'B' or 'U'
+    segment, with 'N's for the UMIs and spacers between
+    """
+    kinds = ''.join(segment.kind for segment in segments) # type: str
+    if 'B' not in kinds:
+        raise ValueError("Barcode %s has no barcode segment in its read layout" % barcode)
+    first, last = kinds.index('B'), max(kinds.rfind('B'), kinds.rfind('U')) # type: int, int
+    if any(segment.length is None for segment in segments[:last + 1]):
+        raise ValueError("The barcodes and UMIs in a read layout must have fixed lengths")
+    if len(barcode) != sum(segment.length for segment in segments if segment.kind == 'B'):
+        raise ValueError("Barcode %s does not fit the read layout's barcode segments" % barcode)
+    placed = '' # type: str
+    used = 0 # type: int
+    for segment in segments[first:last + 1]: # type: Segment
+        if segment.kind == 'B':
+            placed += barcode[used:used + segment.length]
+            used += segment.length
+        else:
+            placed += 'N' * segment.length
+    return Placement(barcode=placed, start=sum(segment.length for segment in segments[:first]))
+
+
+def apply_layouts(barcodes: Dict[str, List[str]], layouts: Dict[str, str]) -> Dict[str, List[Placement]]:
+    """Place every sample's barcodes in its read layout
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    layouts [Dict[str, str]]:           Read layouts for some or all of the samples,
+                                            barcodes of other samples start their reads
+
+    Returns a dictionary where the key is the sample ID and the value is a list of
+    Placements, one per barcode
+    """
+    placements = dict() # type: Dict[str, List[Placement]]
+    for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+        barcode_list = list(filter(None, barcode_list)) # type: List[str]
+        if layouts.get(sample_name):
+            reads = parse_layout(layouts[sample_name]) # type: List[Tuple[Segment, ...]]
+            placements[sample_name] = [place_barcode(barcode, reads[min(index, len(reads) - 1)]) for index, barcode in enumerate(barcode_list)]
+        else:
+            placements[sample_name] = [Placement(barcode=barcode, start=0) for barcode in barcode_list]
+    return placements
+
+
+def search_windows(placements: Dict[str, List[Placement]], shift: int=0) -> Dict[str, Tuple[Tuple[int, int], ...]]:
+    """Get the part of each read to search for each sample's barcodes
+    placements [Dict[str, List[Placement]]]:    Placed barcodes from 'apply_layouts'
+    shift [int]=0                               How far the barcodes may be shifted from
+                                                    their place in the layout
+
+    Returns a dictionary where the key is the sample ID and the value is a tuple
+    of (start, end) windows, one per barcode
+    """
+    return {
+        sample_name: tuple((max(place.start - shift, 0), place.start + len(place.barcode) + shift) for place in places)
+        for sample_name, places in placements.items()
+    }
+
+
+def _search(read: fastq.Read, regexes: Tuple, windows: Optional[Tuple[Tuple[int, int], ...]]=None) -> Optional[List]:
+    """Search a read, or the windows of a read, for a sample's compiled barcodes, returns the matches or None"""
+    windows = windows or ((0, None), (0, None))
+    if len(regexes) == 1:
+        matches = [regexes[0].search(read.forward, *windows[0])] # type: List[_regex.Match]
+    elif len(regexes) == 2:
+        if not read.paired:
+            return None
+        matches = [regexes[0].search(read.forward, *windows[0]), regexes[1].search(read.reverse, *windows[1])]
+    else:
+        raise ValueError("There only be one or two barcodes")
+    if not all(matches):
+        return None
+    return matches
+
+
+def _errors(matches: List) -> int:
+    """Count the substitutions, insertions, and deletions in a set of matches"""
+    return sum(sum(match.fuzzy_counts) for match in matches)
+
+
+def _trim(read: fastq.Read, regexes: Tuple, matches: List, umis: bool=False) -> fastq.Read:
+    """Trim the matched barcodes from a read in place, and move the UMIs matched by 'N's into its IDs if 'umis'"""
+    umi_spans = (list(), list()) # type: Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]
+    for index, reg in enumerate(regexes): # type: int, _regex.Pattern
+        reverse = bool(index % 2) # type: bool
+        umi_groups = set(reg.groupindex.values()) # type: Set[int]
+        for group in range(1, reg.groups + 1): # type: int
+            start, end = matches[index].span(group) # type: int, int
+            if group in umi_groups:
+                umi_spans[index].append((start, end))
+            elif end > start:
+                read.trim(start=start, end=end, reverse=reverse)
+    if umis:
+        _move_umis(read=read, forward=umi_spans[0], reverse=umi_spans[1])
+    return read
+
+
+def _move_umis(read: fastq.Read, forward: List[Tuple[int, int]], reverse: List[Tuple[int, int]]) -> None:
+    """Trim UMIs from a read in place and add their bases to its IDs, forward then reverse"""
+    if not forward and not reverse:
+        return
+    umi = ''.join(read.forward[start:end] for start, end in forward) # type: str
+    for start, end in forward: # type: int, int
+        read.trim(start=start, end=end)
+    if reverse:
+        umi += ''.join(read.reverse[start:end] for start, end in reverse)
+        for start, end in reverse: # type: int, int
+            read.trim(start=start, end=end, reverse=True)
+    read.add_umi(umi)
+
+
 def match_barcode(read: fastq.Read, barcodes: Union[Tuple[str], List[str]], error_rate: Optional[int]=None) -> Optional[fastq.Read]:
     """Match a read to a specific pair of barcodes
     read [fastq.Read]                           A read object to try matching with this set of barcodes
     barcodes [Collection[str, Optional[str]]]:  A tuple or list of one or two barcode sequences
     error_rate [int]=None                       The error rate
     """
-    barcodes = filter(None, barcodes) # type: filter
-    regexes = tuple(map(lambda tup: barcode_to_regex(*tup), zip(barcodes, itertools.repeat(error_rate)))) # type: Tuple
-    matches = list() # type: List
-    if len(regexes) == 1:
-        matches.append(regexes[0].search(read.forward))
+    regexes = tuple(barcode_to_regex(barcode, error_rate) for barcode in filter(None, barcodes)) # type: Tuple[_regex.Pattern]
+    matches = _search(read=read, regexes=regexes) # type: Optional[List[_regex.Match]]
+    if matches is None:
+        return None
+    return _trim(read=read.copy(), regexes=regexes, matches=matches)
+
+
+def classify(
+        read: fastq.Read,
+        patterns: Dict[str, Tuple],
+        windows: Optional[Dict[str, Tuple]]=None,
+        umis: bool=False
+) -> Assignment:
+    """Assign a read to the sample whose barcodes match with the fewest errors
+    read [fastq.Read]                   A read object to classify
+    patterns [Dict[str, Tuple]]:        Compiled barcodes from 'compile_barcodes'
+    windows [Dict[str, Tuple]]=None     Optional windows to search from 'search_windows',
+                                            whole reads are searched for samples without one
+    umis [bool]=False                   Move the bases matched by the 'N's of the barcodes
+                                            into the read IDs of assigned reads
+
+    Reads that match several samples equally well are ambiguous and are not assigned,
+    an assigned read has its barcodes trimmed in place
+    """
+    best = None # type: Optional[str]
+    best_errors = None # type: Optional[int]
+    best_matches = None # type: Optional[List[_regex.Match]]
+    tied = False # type: bool
+    for sample_name, regexes in patterns.items(): # type: str, Tuple[_regex.Pattern]
+        matches = _search(read=read, regexes=regexes, windows=windows and windows.get(sample_name)) # type: Optional[List[_regex.Match]]
+        if matches is None:
+            continue
+        errors = _errors(matches=matches) # type: int
+        if best_errors is None or errors < best_errors:
+            best, best_errors, best_matches, tied = sample_name, errors, matches, False
+        elif errors == best_errors:
+            tied = True
+    if best is None:
+        return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+    if tied:
+        return Assignment(sample=None, read=None, errors=best_errors, ambiguous=True)
+    trimmed = _trim(read=read, regexes=patterns[best], matches=best_matches, umis=umis) # type: fastq.Read
+    return Assignment(sample=best, read=trimmed, errors=best_errors, ambiguous=False)
+
+
+class DualIndex(object):
+
+    """Classify dual-indexed reads by resolving the forward (i7) and reverse (i5) barcodes on their own
+    Each distinct barcode is compiled and searched once per read, however many samples
+    share it, for its match with the fewest errors. The pairs of barcodes found are scored
+    by their total errors against a table of samples, and the read goes to the sample with
+    the fewest. Reads with no sample's pair within the error rate, but an exact match of
+    one barcode in each index, are index hops, and are reported by their barcodes without
+    the 'N's of UMIs and spacers at either end. As in Illumina's index hopping reports,
+    only exact matches are counted, a barcode read with more errors than the error rate
+    can come within it of another sample's barcode and look like a hop
+    """
+
+    def __init__(
+            self,
+            barcodes: Dict[str, List[str]],
+            error_rate: Optional[int]=None,
+            windows: Optional[Dict[str, Tuple]]=None,
+            umis: bool=False
+    ) -> None:
+        """
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of two barcode sequences
+    error_rate [int]=None               The error rate
+    windows [Dict[str, Tuple]]=None     Optional windows to search from 'search_windows',
+                                            whole reads are searched for samples without one
+    umis [bool]=False                   Move the bases matched by the 'N's of the barcodes
+                                            into the read IDs of assigned reads
+    """
+        windows = windows or dict() # type: Dict[str, Tuple]
+        self._umis = umis # type: bool
+        self._samples = dict() # type: Dict[Tuple[Tuple, Tuple], str]
+        self._indexes = (dict(), dict()) # type: Tuple[Dict[Tuple, _regex.Pattern], ...]
+        for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+            barcode_list = tuple(barcode.upper() for barcode in filter(None, barcode_list)) # type: Tuple[str, ...]
+            if len(barcode_list) != 2:
+                raise ValueError("Every sample needs two barcodes to be dual-indexed")
+            sample_windows = windows.get(sample_name) or ((0, None), (0, None)) # type: Tuple[Tuple[int, int], ...]
+            key = tuple(zip(barcode_list, sample_windows)) # type: Tuple[Tuple, Tuple]
+            if key in self._samples:
+                raise ValueError("Samples %s and %s have the same barcodes" % (self._samples[key], sample_name))
+            self._samples[key] = sample_name
+            for index, barcode in zip(self._indexes, key): # type: Dict[Tuple, _regex.Pattern], Tuple
+                if barcode not in index:
+                    index[barcode] = barcode_to_regex(barcode[0], error_rate, best=True)
+
+    @staticmethod
+    def _resolve(sequence: str, index: Dict[Tuple, Any]) -> Dict[Tuple, Tuple[Any, int]]:
+        """Find every barcode of an index that matches a sequence within the error rate,
+        returns each barcode's best match and its errors"""
+        found = dict() # type: Dict[Tuple, Tuple[_regex.Match, int]]
+        for barcode, pattern in index.items(): # type: Tuple, _regex.Pattern
+            match = pattern.search(sequence, *barcode[1])
+            if match is not None:
+                found[barcode] = (match, sum(match.fuzzy_counts))
+        return found
+
+    @staticmethod
+    def _exact(found: Dict[Tuple, Tuple[Any, int]]) -> Optional[Tuple]:
+        """The one barcode found with no errors, or None"""
+        exact = [barcode for barcode, (match, errors) in found.items() if errors == 0] # type: List[Tuple]
+        return exact[0] if len(exact) == 1 else None
+
+    def classify(self, read: fastq.Read) -> Assignment:
+        """Assign a read to the sample with the pair of barcodes found in it
+        read [fastq.Read]   A read object to classify, trimmed in place when assigned
+        """
+        if not read.paired:
+            return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+        forward = self._resolve(read.forward, self._indexes[0]) # type: Dict[Tuple, Tuple[_regex.Match, int]]
+        if not forward:
+            return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+        reverse = self._resolve(read.reverse, self._indexes[1]) # type: Dict[Tuple, Tuple[_regex.Match, int]]
+        if not reverse:
+            return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+        best = None # type: Optional[Tuple[Tuple, Tuple]]
+        best_errors = None # type: Optional[int]
+        tied = False # type: bool
+        for pair in itertools.product(forward, reverse): # type: Tuple[Tuple, Tuple]
+            if pair not in self._samples:
+                continue
+            errors = forward[pair[0]][1] + reverse[pair[1]][1] # type: int
+            if best_errors is None or errors < best_errors:
+                best, best_errors, tied = pair, errors, False
+            elif errors == best_errors:
+                tied = True
+        if tied:
+            return Assignment(sample=None, read=None, errors=best_errors, ambiguous=True)
+        if best is None:
+            #   No sample has a pair of the barcodes found, it is a hop if each index has an exact match
+            hop = (self._exact(forward), self._exact(reverse)) # type: Tuple[Optional[Tuple], Optional[Tuple]]
+            if None in hop:
+                return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+            return Assignment(sample=None, read=None, errors=0, ambiguous=False, hopped=(hop[0][0].strip('N'), hop[1][0].strip('N')))
+        regexes = (self._indexes[0][best[0]], self._indexes[1][best[1]]) # type: Tuple[_regex.Pattern, _regex.Pattern]
+        matches = [forward[best[0]][0], reverse[best[1]][0]] # type: List[_regex.Match]
+        trimmed = _trim(read=read, regexes=regexes, matches=matches, umis=self._umis) # type: fastq.Read
+        return Assignment(sample=self._samples[best], read=trimmed, errors=best_errors, ambiguous=False)
+
+
+class BarcodeIndex(object):
+
+    """A lookup table of every variant of a set of fixed-length barcodes
+    Each barcode is expanded once, both its IUPAC codes and every sequence within
+    'error_rate' substitutions, and each variant maps back to the barcode it came from.
+    'N's in the barcodes are UMI positions and are skipped when looking up a window.
+    A variant keeps every barcode within 'error_rate' of it, closest first, so that
+    pairs of barcodes can be scored by their total mismatches
+    """
+
+    AMBIGUOUS = '' # type: str
+
+    def __init__(self, barcodes: Iterable[str], error_rate: Optional[int]=None) -> None:
+        """
+    barcodes [Iterable[str]]:   Barcode sequences, all the same length with 'N's in the same places
+    error_rate [int]=None       The number of substitutions allowed
+    """
+        barcodes = sorted(set(barcode.upper() for barcode in barcodes)) # type: List[str]
+        if not barcodes:
+            raise ValueError("At least one barcode is needed to build an index")
+        lengths = set(map(len, barcodes)) # type: Set[int]
+        masks = set(tuple(i for i, base in enumerate(barcode) if base != 'N') for barcode in barcodes) # type: Set[Tuple[int]]
+        if len(lengths) != 1 or len(masks) != 1:
+            raise ValueError("Barcodes must share one length and UMI layout to be indexed")
+        self._length = lengths.pop() # type: int
+        self._positions = masks.pop() # type: Tuple[int]
+        self._index = dict() # type: Dict[str, Tuple[Tuple[str, int], ...]]
+        #   Most variants are close to a single barcode, they share one tuple per barcode and distance
+        self._single = dict() # type: Dict[Tuple[str, int], Tuple[Tuple[str, int]]]
+        for barcode in barcodes: # type: str
+            key = ''.join(barcode[i] for i in self._positions) # type: str
+            for expanded in unpack([expand_iupac(key)]): # type: str
+                for variant, mismatches in _neighborhood(expanded, error_rate or 0): # type: str, int
+                    self._add(variant=variant, barcode=barcode, mismatches=mismatches)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _add(self, variant: str, barcode: str, mismatches: int) -> None:
+        known = self._index.get(variant) # type: Optional[Tuple[Tuple[str, int], ...]]
+        if known is None:
+            self._index[variant] = self._single.setdefault((barcode, mismatches), ((barcode, mismatches),))
+            return
+        found = dict(known) # type: Dict[str, int]
+        if found.get(barcode, mismatches + 1) <= mismatches:
+            return
+        found[barcode] = mismatches
+        self._index[variant] = tuple(sorted(found.items(), key=lambda candidate: candidate[1]))
+
+    def _get_length(self) -> int:
+        return self._length
+
+    def _get_positions(self) -> Tuple[int]:
+        return self._positions
+
+    def lookup(self, sequence: str, offset: int=0) -> Tuple[Optional[str], Optional[int]]:
+        """Find the barcode at a position in a sequence
+        sequence [str]:     The sequence to look in
+        offset [int]=0      Where the barcode starts in the sequence
+
+        Returns the closest barcode and the number of mismatches, the barcode is
+        BarcodeIndex.AMBIGUOUS when two barcodes are as close and None for no match
+        """
+        found = self.candidates(sequence, offset) # type: Tuple[Tuple[str, int], ...]
+        if not found:
+            return None, None
+        if len(found) > 1 and found[1][1] == found[0][1]:
+            return self.AMBIGUOUS, found[0][1]
+        return found[0]
+
+    def candidates(self, sequence: str, offset: int=0) -> Tuple[Tuple[str, int], ...]:
+        """Find every barcode within the error rate at a position in a sequence
+        sequence [str]:     The sequence to look in
+        offset [int]=0      Where the barcode starts in the sequence
+
+        Returns (barcode, mismatches) pairs, closest first, and no pairs for no match
+        """
+        window = sequence[offset:offset + self._length] # type: str
+        if len(window) != self._length:
+            return ()
+        if len(self._positions) != self._length:
+            window = ''.join(window[i] for i in self._positions)
+        return self._index.get(window, ())
+
+    def cuts(self, offset: int=0) -> List[Tuple[int, int]]:
+        """The (start, end) spans of the barcode bases, skipping UMIs"""
+        return _runs(positions=self._positions, offset=offset)
+
+    def umi_cuts(self, offset: int=0) -> List[Tuple[int, int]]:
+        """The (start, end) spans of the UMIs, the 'N's of the barcodes"""
+        return _runs(positions=(i for i in range(self._length) if i not in self._positions), offset=offset)
+
+    length = property(fget=_get_length, doc='Length of the indexed barcodes')
+    positions = property(fget=_get_positions, doc='Barcode positions that are not UMIs')
+
+
+def _runs(positions: Iterable[int], offset: int=0) -> List[Tuple[int, int]]:
+    """Join increasing positions into (start, end) spans, moved along by 'offset'"""
+    spans = list() # type: List[Tuple[int, int]]
+    for position in positions: # type: int
+        if spans and spans[-1][1] == position + offset:
+            spans[-1] = (spans[-1][0], position + offset + 1)
+        else:
+            spans.append((position + offset, position + offset + 1))
+    return spans
+
+
+def _neighborhood(barcode: str, error_rate: int) -> Iterator[Tuple[str, int]]:
+    """Yield every sequence within 'error_rate' substitutions of a barcode and its distance"""
+    yield barcode, 0
+    for mismatches in range(1, min(error_rate, len(barcode)) + 1): # type: int
+        for positions in itertools.combinations(range(len(barcode)), mismatches): # type: Tuple[int]
+            choices = tuple(tuple(base for base in 'ACGTN' if base != barcode[i]) for i in positions) # type: Tuple[Tuple[str]]
+            for bases in itertools.product(*choices): # type: Tuple[str]
+                variant = list(barcode) # type: List[str]
+                for position, base in zip(positions, bases): # type: int, str
+                    variant[position] = base
+                yield ''.join(variant), mismatches
+
+
+class SampleIndex(object):
+
+    """Classify reads by looking up barcodes at a fixed offset in one or two BarcodeIndexes
+    Samples with two barcodes are resolved by the pair of forward and reverse barcodes with the
+    fewest total mismatches, and with 'hops', exact matches of a pair that no sample has are index hops
+    """
+
+    def __init__(self, barcodes: Dict[str, List[str]], error_rate: Optional[int]=None, offset: int=0, umis: bool=False, hops: bool=False) -> None:
+        """
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    error_rate [int]=None               The number of substitutions allowed per barcode
+    offset [int]=0                      Where the barcodes start in the reads
+    umis [bool]=False                   Move the bases under the 'N's of the barcodes into
+                                            the read IDs of assigned reads
+    hops [bool]=False                   Report index hops, for dual-indexed samples
+    """
+        self._offset = offset # type: int
+        self._hops = hops # type: bool
+        self._umis = umis # type: bool
+        self._samples = dict() # type: Dict[Tuple[str, ...], str]
+        for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+            key = tuple(barcode.upper() for barcode in filter(None, barcode_list)) # type: Tuple[str, ...]
+            if len(key) not in (1, 2):
+                raise ValueError("There only be one or two barcodes")
+            self._samples[key] = sample_name
+        self._forward = BarcodeIndex(barcodes=(key[0] for key in self._samples), error_rate=error_rate) # type: BarcodeIndex
+        reverse_barcodes = tuple(key[1] for key in self._samples if len(key) == 2) # type: Tuple[str]
+        if reverse_barcodes:
+            self._reverse = BarcodeIndex(barcodes=reverse_barcodes, error_rate=error_rate) # type: Optional[BarcodeIndex]
+        else:
+            self._reverse = None
+
+    def classify(self, read: fastq.Read) -> Assignment:
+        """Assign a read to a sample with one lookup per barcode
+        read [fastq.Read]   A read object to classify, trimmed in place when assigned
+
+        Every sample whose barcodes are all within the error rate is scored by its total
+        mismatches, as in 'MatrixIndex', and reads with a tie for the fewest are ambiguous
+        """
+        forward = self._forward.candidates(read.forward, self._offset) # type: Tuple[Tuple[str, int], ...]
+        reverse = self._reverse.candidates(read.reverse, self._offset) if self._reverse and read.paired else () # type: Tuple[Tuple[str, int], ...]
+        key = None # type: Optional[Tuple[str, ...]]
+        errors = None # type: Optional[int]
+        tied = False # type: bool
+        for forward_barcode, forward_errors in forward: # type: str, int
+            scores = [((forward_barcode,), forward_errors)] # type: List[Tuple[Tuple[str, ...], int]]
+            scores.extend(((forward_barcode, reverse_barcode), forward_errors + reverse_errors) for reverse_barcode, reverse_errors in reverse)
+            for candidate, candidate_errors in scores: # type: Tuple[str, ...], int
+                if candidate not in self._samples:
+                    continue
+                if errors is None or candidate_errors < errors:
+                    key, errors, tied = candidate, candidate_errors, False
+                elif candidate_errors == errors:
+                    tied = True
+        if key is None:
+            #   Only pairs of exact matches are counted as hops, as in 'DualIndex'
+            exact = tuple([barcode for barcode, mismatches in found if not mismatches] for found in (forward, reverse)) # type: Tuple[List[str], List[str]]
+            if self._hops and len(exact[0]) == len(exact[1]) == 1:
+                return Assignment(sample=None, read=None, errors=0, ambiguous=False, hopped=(exact[0][0].strip('N'), exact[1][0].strip('N')))
+            return Assignment(sample=None, read=None, errors=None, ambiguous=False)
+        if tied:
+            return Assignment(sample=None, read=None, errors=errors, ambiguous=True)
+        for start, end in self._forward.cuts(self._offset): # type: int, int
+            read.trim(start=start, end=end)
+        if len(key) == 2:
+            for start, end in self._reverse.cuts(self._offset): # type: int, int
+                read.trim(start=start, end=end, reverse=True)
+        if self._umis:
+            _move_umis(
+                read=read,
+                forward=self._forward.umi_cuts(self._offset),
+                reverse=self._reverse.umi_cuts(self._offset) if len(key) == 2 else list()
+            )
+        return Assignment(sample=self._samples[key], read=read, errors=errors, ambiguous=False)
+
+
+class MatrixIndex(object):
+
+    """Classify batches of reads by their Hamming distances to every barcode at a fixed offset
+    Barcodes and the windows of a batch of reads are encoded as matrices of base masks
+    (A=1, C=2, G=4, T=8), where IUPAC codes combine the masks of their bases and 'N's in
+    barcodes match anything, so the distances from every read to every barcode are found
+    at once with NumPy. Nothing is precomputed per variant, so barcodes may have any length
+    and layout, and large error rates cost no more memory than small ones
+    """
+
+    #   Mask for bases in reads that are not A, C, G, or T, matched only by 'N's in barcodes
+    OTHER = 16 # type: int
+    #   Mask for the positions past the end of a read, matched only by 'N's and padding
+    PAST_END = 32 # type: int
+    WILDCARD = 255 # type: int
+
+    def __init__(self, barcodes: Dict[str, List[str]], error_rate: Optional[int]=None, offset: int=0, umis: bool=False, hops: bool=False) -> None:
+        """
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    error_rate [int]=None               The number of substitutions allowed per barcode
+    offset [int]=0                      Where the barcodes start in the reads
+    umis [bool]=False                   Move the bases under the 'N's of the barcodes into
+                                            the read IDs of assigned reads
+    hops [bool]=False                   Report index hops, for dual-indexed samples
+    """
         try:
-            matches.append(regexes[0].search(read.reverse))
-        except TypeError:
-            pass
-    elif len(regexes) == 2:
-        matches.append(regexes[0].search(read.forward))
-        matches.append(regexes[1].search(read.reverse))
-    else:
-        raise ValueError("There only be one or two barcodes")
+            import numpy as np
+        except ImportError as error:
+            sys.exit("Please install " + error.name)
+        self._np = np
+        self._offset = offset # type: int
+        self._hops = hops # type: bool
+        self._error_rate = error_rate or 0 # type: int
+        self._samples = list() # type: List[str]
+        forward = list() # type: List[str]
+        reverse = list() # type: List[Optional[str]]
+        for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+            barcode_list = tuple(barcode.upper() for barcode in filter(None, barcode_list)) # type: Tuple[str, ...]
+            if len(barcode_list) not in (1, 2):
+                raise ValueError("There only be one or two barcodes")
+            self._samples.append(sample_name)
+            forward.append(barcode_list[0])
+            reverse.append(barcode_list[1] if len(barcode_list) == 2 else None)
+        self._table = np.full(256, self.OTHER, dtype=np.uint8)
+        for mask, base in enumerate('ACGT'): # type: int, str
+            self._table[ord(base)] = self._table[ord(base.lower())] = 1 << mask
+        self._table[ord('.')] = self.PAST_END
+        self._barcodes = (forward, reverse) # type: Tuple[List[str], List[Optional[str]]]
+        self._forward = self._encode(forward)
+        self._reverse = self._encode(reverse)
+        self._dual = np.array([barcode is not None for barcode in reverse], dtype=bool)
+        self._cuts = [(self._spans(fwd), self._spans(rev)) for fwd, rev in zip(forward, reverse)] # type: List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]]
+        if umis:
+            self._umi_cuts = [(self._spans(fwd, umis=True), self._spans(rev, umis=True)) for fwd, rev in zip(forward, reverse)] # type: Optional[List[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]]]
+        else:
+            self._umi_cuts = None
+
+    def _encode(self, barcodes: List[Optional[str]]):
+        """Encode barcodes as a (samples x length) matrix of base masks"""
+        masks = dict(zip('ACGT', (1, 2, 4, 8))) # type: Dict[str, int]
+        for code, bases in IUPAC_CODES.items(): # type: str, str
+            masks[code] = sum(masks[base] for base in bases)
+        length = max((len(barcode) for barcode in barcodes if barcode), default=0) # type: int
+        encoded = self._np.full((len(barcodes), length), self.WILDCARD, dtype=self._np.uint8)
+        for row, barcode in enumerate(barcodes): # type: int, Optional[str]
+            for column, base in enumerate(barcode or ''): # type: int, str
+                if base not in masks and base != 'N':
+                    raise ValueError("Cannot encode barcode " + barcode)
+                encoded[row, column] = masks.get(base, self.WILDCARD)
+        return encoded
+
+    def _spans(self, barcode: Optional[str], umis: bool=False) -> List[Tuple[int, int]]:
+        """The (start, end) spans of a barcode's bases in a read, skipping UMIs, or of its UMIs if 'umis'"""
+        return _runs(positions=(i for i, base in enumerate(barcode or '') if (base == 'N') == umis), offset=self._offset)
+
+    def _distances(self, sequences: List[str], encoded):
+        """Count the mismatches between the windows of every sequence and every encoded barcode"""
+        np = self._np
+        length = encoded.shape[1] # type: int
+        windows = ''.join(seq[self._offset:self._offset + length].ljust(length, '.') for seq in sequences) # type: str
+        reads = self._table[np.frombuffer(windows.encode('ascii', 'replace'), dtype=np.uint8)].reshape(len(sequences), length)
+        distance = np.zeros((len(sequences), encoded.shape[0]), dtype=np.uint16)
+        for position in range(length): # type: int
+            distance += (reads[:, position, None] & encoded[None, :, position]) == 0
+        return distance
+
+    def _hop(self, forward, reverse) -> Optional[Tuple[str, str]]:
+        """The forward and reverse barcodes of an unassigned read, when each matches exactly one
+        barcode with no mismatches, without the 'N's at either end, as in 'SampleIndex'"""
+        found = ( # type: Tuple[Set[str], Set[str]]
+            {self._barcodes[0][column] for column in self._np.flatnonzero(forward == 0).tolist()},
+            {self._barcodes[1][column] for column in self._np.flatnonzero((reverse == 0) & self._dual).tolist()}
+        )
+        if len(found[0]) != 1 or len(found[1]) != 1:
+            return None
+        return found[0].pop().strip('N'), found[1].pop().strip('N')
+
+    def classify_batch(self, reads: List[fastq.Read]) -> List[Assignment]:
+        """Assign a batch of reads to samples with one distance matrix per barcode
+        reads [List[fastq.Read]]    Read objects to classify, each trimmed in place when assigned
+
+        A read goes to the sample with the fewest total mismatches, when every one of the
+        sample's barcodes is within the error rate; reads with a tie for the fewest are ambiguous,
+        and with 'hops', unassigned reads with exact matches of a forward and a reverse barcode are index hops
+        """
+        np = self._np
+        if not reads:
+            return list()
+        unmatched = np.iinfo(np.uint16).max # type: int
+        forward = self._distances([read.forward for read in reads], self._forward)
+        distance = forward.copy()
+        distance[distance > self._error_rate] = unmatched
+        reverse_distance = None
+        if self._dual.any():
+            paired = np.array([read.paired for read in reads], dtype=bool)
+            reverse_distance = self._distances([read.reverse if read.paired else '' for read in reads], self._reverse)
+            reverse = reverse_distance.copy()
+            reverse[:, ~self._dual] = 0
+            reverse[reverse > self._error_rate] = unmatched
+            reverse[~paired[:, None] & self._dual[None, :]] = unmatched
+            distance = np.minimum(distance.astype(np.uint32) + reverse, unmatched)
+        rows = np.arange(len(reads))
+        closest = distance.argmin(axis=1)
+        fewest = distance[rows, closest]
+        distance[rows, closest] = unmatched
+        runner_up = distance.min(axis=1)
+        assignments = list() # type: List[Assignment]
+        for row, (read, first, errors, second) in enumerate(zip(reads, closest.tolist(), fewest.tolist(), runner_up.tolist())): # type: int, Tuple[fastq.Read, int, int, int]
+            if errors == unmatched:
+                hopped = self._hop(forward[row], reverse_distance[row]) if self._hops and reverse_distance is not None and read.paired else None # type: Optional[Tuple[str, str]]
+                assignments.append(Assignment(sample=None, read=None, errors=0 if hopped else None, ambiguous=False, hopped=hopped))
+            elif errors == second:
+                assignments.append(Assignment(sample=None, read=None, errors=errors, ambiguous=True))
+            else:
+                forward_cuts, reverse_cuts = self._cuts[first] # type: List[Tuple[int, int]], List[Tuple[int, int]]
+                for start, end in forward_cuts: # type: int, int
+                    read.trim(start=start, end=end)
+                for start, end in reverse_cuts: # type: int, int
+                    read.trim(start=start, end=end, reverse=True)
+                if self._umi_cuts:
+                    _move_umis(read, *self._umi_cuts[first])
+                assignments.append(Assignment(sample=self._samples[first], read=read, errors=errors, ambiguous=False))
+        return assignments
+
+
+def new_counts(samples: Iterable[str]) -> Dict[str, Any]:
+    """Make an empty set of counts for partitioning reads between samples
+    samples [Iterable[str]]:    The sample names
+
+    'reads' counts every read, 'unassigned' reads that matched no sample and
+    'ambiguous' reads that matched several samples equally well; 'assigned'
+    counts reads per sample and 'mismatches' holds a histogram per sample,
+    where the value at index 'i' counts reads assigned with 'i' errors;
+    'unknown_barcodes' is a sketch.SpaceSaving of the bases found where the
+    barcodes should be in unassigned reads; 'index_hopping' counts unassigned
+    dual-indexed reads by their forward and then their reverse barcode; 'umis'
+    holds a sketch.UmiCounter per sample when UMIs are moved into read IDs
+    """
+    samples = tuple(samples) # type: Tuple[str]
+    return {
+        'reads': 0,
+        'unassigned': 0,
+        'ambiguous': 0,
+        'assigned': dict.fromkeys(samples, 0),
+        'mismatches': {sample_name: list() for sample_name in samples},
+        'unknown_barcodes': sketch.SpaceSaving(capacity=SKETCH_SIZE),
+        'index_hopping': dict(),
+        'umis': dict()
+    }
+
+
+def count_assignment(counts: Dict[str, Any], assignment: Assignment) -> None:
+    """Add the outcome of classifying one read to a set of counts from 'new_counts'"""
+    counts['reads'] += 1
+    if assignment.sample is None:
+        counts['ambiguous' if assignment.ambiguous else 'unassigned'] += 1
+        if assignment.hopped:
+            forward, reverse = assignment.hopped # type: str, str
+            hops = counts['index_hopping'].setdefault(forward, dict()) # type: Dict[str, int]
+            hops[reverse] = hops.get(reverse, 0) + 1
+        return
+    counts['assigned'][assignment.sample] += 1
+    histogram = counts['mismatches'][assignment.sample] # type: List[int]
+    if len(histogram) <= assignment.errors:
+        histogram.extend(itertools.repeat(0, assignment.errors + 1 - len(histogram)))
+    histogram[assignment.errors] += 1
+    if assignment.read.umi is not None:
+        umis = counts['umis'].get(assignment.sample) # type: Optional[sketch.UmiCounter]
+        if umis is None:
+            umis = counts['umis'][assignment.sample] = sketch.UmiCounter()
+        umis.add(assignment.read.umi)
+
+
+def barcode_window(
+        barcodes: Dict[str, List[str]],
+        offset: Optional[int]=None,
+        placements: Optional[Dict[str, List[Placement]]]=None
+) -> Callable[[fastq.Read], str]:
+    """Make a function that gets the bases where the barcodes should be in a read
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    offset [int]=None                   Where the barcodes start in the reads, defaults to
+                                            where they are placed or 0
+    placements [Dict[str, List[Placement]]]=None    Optional barcodes placed in read layouts
+                                                        by 'apply_layouts'
+
+    The first forward, and reverse, barcodes are used as templates; UMI positions are
+    skipped, and forward and reverse bases are joined by a '+'
+    """
+    templates = list() # type: List[Tuple[int]]
+    for index in (0, 1): # type: int
+        for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
+            barcode_list = tuple(filter(None, barcode_list)) # type: Tuple[str]
+            if len(barcode_list) > index:
+                barcode, start = barcode_list[index], offset or 0 # type: str, int
+                if placements:
+                    barcode = placements[sample_name][index].barcode
+                    if offset is None:
+                        start = placements[sample_name][index].start
+                templates.append(tuple(i + start for i, base in enumerate(barcode.upper()) if base != 'N'))
+                break
+
+    def window(read: fastq.Read) -> str:
+        windows = [''.join(read.forward[i] for i in templates[0] if i < len(read.forward))] # type: List[str]
+        if len(templates) == 2 and read.paired:
+            windows.append(''.join(read.reverse[i] for i in templates[1] if i < len(read.reverse)))
+        return '+'.join(windows)
+
+    return window
+
+
+def _put(pipe: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """Put an item on a bounded queue, unless the pipeline stops while waiting; returns whether it was put"""
+    while not stop.is_set():
+        try:
+            pipe.put(item, timeout=PIPELINE_POLL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(pipe: queue.Queue, stop: threading.Event) -> Any:
+    """Get an item from a queue, or _END if the pipeline stops while waiting"""
+    while not stop.is_set():
+        try:
+            return pipe.get(timeout=PIPELINE_POLL)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _profiled(target: Callable[..., None], profilers: Optional[List[cProfile.Profile]]) -> Callable[..., None]:
+    """Wrap a thread's target to run under a cProfile.Profile of its own, added to 'profilers', when they are given;
+    from Python 3.12 a profiler records every thread and only one can be enabled at a time, so when the
+    thread's own profiler cannot be enabled it runs under the profiler already enabled in its process"""
+    if profilers is None:
+        return target
+    def run(*args: Any) -> None:
+        profiler = cProfile.Profile() # type: cProfile.Profile
+        try:
+            profiler.enable()
+        except ValueError:
+            target(*args)
+            return
+        profilers.append(profiler)
+        try:
+            target(*args)
+        finally:
+            profiler.disable()
+    return run
+
+
+def _read_batches(reads: Iterator[fastq.Read], batches: queue.Queue, timer: instrument.StageTimer, stop: threading.Event, errors: List[BaseException]) -> None:
+    """Read batches of BATCH_SIZE reads onto a queue, followed by _END; the reading thread of 'partition'"""
     try:
-        trimmed = deepcopy(read) # type: fastq.Read
-        for index, reg in enumerate(regexes): # type: int, _regex.Pattern
-            reverse = bool(index % 2) # type: bool
-            for i in range(reg.groups): # type: int
-                if i % 2 != 0:
-                    continue
-                start, end = matches[index].span(i + 1) # type: int, int
-                trimmed.trim(start=start, end=end, reverse=reverse)
-    except AttributeError:
-        return None
-    return trimmed
+        while True:
+            with timer.stage('parsing'):
+                batch = list(itertools.islice(reads, BATCH_SIZE)) # type: List[fastq.Read]
+            if not batch or not _put(pipe=batches, item=batch, stop=stop):
+                break
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+    _put(pipe=batches, item=_END, stop=stop)
+
+
+def _write_batches(matched: queue.Queue, write: Callable[[fastq.Read, Assignment], None], timer: instrument.StageTimer, stop: threading.Event, errors: List[BaseException]) -> None:
+    """Count and write batches of reads and their Assignments from a queue until _END; the writing thread of 'partition'"""
+    try:
+        while True:
+            item = _get(pipe=matched, stop=stop) # type: Any
+            if item is _END:
+                break
+            with timer.stage('writing'):
+                for read, assignment in zip(*item): # type: fastq.Read, Assignment
+                    write(read, assignment)
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+
+
+def build_classifier(
+        barcodes: Dict[str, List[str]],
+        error_rate: Optional[int]=None,
+        offset: Optional[int]=None,
+        matcher: Optional[str]=None,
+        layouts: Optional[Dict[str, str]]=None,
+        shift: Optional[int]=None,
+        dual_index: bool=False,
+        umis: bool=False
+) -> Tuple[Callable[[List[fastq.Read]], Iterable[Assignment]], Dict[str, List[Placement]]]:
+    """Build the function that classifies a batch of reads, and keep it for the rest of the process
+    barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
+                                            the value is a list or tuple of one or two
+                                            barcode sequences
+    error_rate [int]=None               The error rate
+    offset [int]=None                   Optional position of fixed-length barcodes in the reads
+    matcher [str]=None                  How to match barcodes at 'offset', one of MATCHERS
+    layouts [Dict[str, str]]=None       Optional read layouts per sample, not with 'offset'
+    shift [int]=None                    How far barcodes may be shifted from their place in the layouts
+    dual_index [bool]=False             Search for the forward and reverse barcodes on their own,
+                                            or at 'offset' report index hops
+    umis [bool]=False                   Have the classifier find the UMIs of assigned reads
+
+    Every chunk a worker partitions, from any input, reuses the classifier built for its
+    first chunk as long as the barcodes and options are the same, so the indexes are built
+    once per worker rather than once per chunk
+
+    Returns the classifier, taking a batch of reads and returning their Assignments, and
+    the placements of the barcodes from 'apply_layouts'
+    """
+    key = json.dumps([barcodes, error_rate, offset, matcher, layouts, shift, dual_index, umis], sort_keys=True) # type: str
+    if key in _CLASSIFIERS:
+        return _CLASSIFIERS[key]
+    if matcher not in (None,) + MATCHERS:
+        raise ValueError("'matcher' must be one of " + ', '.join(MATCHERS))
+    if offset is not None and layouts:
+        raise ValueError("'offset' cannot be given with read layouts, which already place the barcodes in the reads")
+    placements = apply_layouts(barcodes=barcodes, layouts=layouts or dict()) # type: Dict[str, List[Placement]]
+    placed = {sample_name: [place.barcode for place in places] for sample_name, places in placements.items()} # type: Dict[str, List[str]]
+    classify_batch = None # type: Optional[Callable[[List[fastq.Read]], Iterable[Assignment]]]
+    if offset is not None and matcher == 'matrix':
+        classify_batch = MatrixIndex(barcodes=placed, error_rate=error_rate, offset=offset, umis=umis, hops=dual_index).classify_batch
+    elif offset is not None:
+        try:
+            classify_batch = functools.partial(map, SampleIndex(barcodes=placed, error_rate=error_rate, offset=offset, umis=umis, hops=dual_index).classify)
+        except ValueError:
+            #   Barcodes of different lengths or layouts fall back to regex matching
+            classify_batch = None
+    if classify_batch is None:
+        windows = search_windows( # type: Dict[str, Tuple]
+            placements={sample_name: places for sample_name, places in placements.items() if (layouts or dict()).get(sample_name)},
+            shift=shift or 0
+        )
+        if dual_index:
+            classify_batch = functools.partial(map, DualIndex(barcodes=placed, error_rate=error_rate, windows=windows, umis=umis).classify)
+        else:
+            patterns = compile_barcodes(barcodes=placed, error_rate=error_rate) # type: Dict[str, Tuple[_regex.Pattern]]
+            classify_batch = functools.partial(map, functools.partial(classify, patterns=patterns, windows=windows, umis=umis))
+    #   Only the latest classifier is kept, a worker serves one run at a time
+    _CLASSIFIERS.clear()
+    _CLASSIFIERS[key] = (classify_batch, placements)
+    return _CLASSIFIERS[key]
 
 
 def partition(
         barcodes: Dict[str, List[str]],
         filename: str,
         reverse: Optional[str]=None,
-        error_rate: Optional[int]=None
-) -> List[Tuple[str, Optional[str]]]:
+        error_rate: Optional[int]=None,
+        offset: Optional[int]=None,
+        forward_range: Optional[Tuple[int, int]]=None,
+        reverse_range: Optional[Tuple[int, int]]=None,
+        prefix: Optional[str]=None,
+        compression: Optional[str]=None,
+        reads: Optional[Iterable[fastq.Read]]=None,
+        matcher: Optional[str]=None,
+        layouts: Optional[Dict[str, str]]=None,
+        shift: Optional[int]=None,
+        output_directory: Optional[str]=None,
+        dual_index: bool=False,
+        max_buffered: Optional[int]=None,
+        extract_umis: bool=False,
+        output_name: Optional[str]=None,
+        profilers: Optional[List[cProfile.Profile]]=None,
+        progress: Optional[Callable[[int], None]]=None,
+        checksums: Optional[List[int]]=None
+) -> Dict[str, Any]:
     """Partition a FASTQ file into component barcodes
     barcodes [Dict[str, List[str]]]:    A dictionary where the key is the sample ID and
                                             the value is a list or tuple of one or two
@@ -119,41 +1057,140 @@ def partition(
     filename [str]                      Forward or single FASTQ filename
     reverse [str]=None                  Optional reverse FASTQ filename
     error_rate [int]=None               The error rate
+    offset [int]=None                   Optional position of fixed-length barcodes in the reads,
+                                            reads are classified with a SampleIndex lookup
+                                            rather than a regex search when this is given
+    forward_range [Tuple[int, int]]=None  Optional (start, end) byte range of 'filename' to partition
+    reverse_range [Tuple[int, int]]=None  Optional (start, end) byte range of 'reverse' to partition
+    prefix [str]=None                   Optional chunk name to prefix the output basenames with
+    compression [str]=None              Optionally compress the output, one of fastq.COMPRESSION
+    reads [Iterable[fastq.Read]]=None   Optional reads to partition instead of reading them from
+                                            'filename' and 'reverse', which still name the output
+    matcher [str]=None                  How to match barcodes at 'offset', one of MATCHERS,
+                                            defaults to 'index'
+    layouts [Dict[str, str]]=None       Optional read layouts, such as '6B8U4S+T', per sample;
+                                            UMIs and spacers in a layout are matched as 'N's
+                                            and only the layout's window is searched; not with 'offset'
+    shift [int]=None                    How far barcodes may be shifted from their place in
+                                            the layouts when searching, defaults to 0
+    output_directory [str]=None         Where to write the output, defaults to the directory
+                                            of 'filename'
+    dual_index [bool]=False             Search for the forward and reverse barcodes on their own
+                                            with a DualIndex rather than sample by sample, when
+                                            every sample has two barcodes and 'offset' is not given;
+                                            index hops are only reported in this mode
+    max_buffered [int]=None             Most characters of output to hold in memory before writing,
+                                            defaults to fastq.MAX_BUFFERED
+    extract_umis [bool]=False           Move the UMIs, the bases under the 'N's of the barcodes and
+                                            the 'U's of the layouts, from assigned reads into
+                                            their read IDs as UMI-tools does, and count them
+    output_name [str]=None              Optional name to give the output after the sample, such as
+                                            'run.fastq' when 'filename' is one of several lanes,
+                                            defaults to the name of 'filename'
+    profilers [List[cProfile.Profile]]=None  Optional list to add a profile of each of the reading
+                                            and writing threads to, cProfile only records the
+                                            thread that enabled it
+    progress [Callable[[int], None]]=None  Optional function called with the number of reads in
+                                            each batch once it is matched
+    checksums [List[int]]=None          Optional list to add the CRC32 of the bytes read from
+                                            'filename' and 'reverse' to, see fastq.iter_fastq
+
+    Each read is visited once and written to the single sample it matches best
+
+    Reads not assigned to a sample are written to the UNDETERMINED output
+
+    Returns the counts from 'new_counts' for this chunk, along with the output
+    filenames for each sample and UNDETERMINED under 'outputs', the wall and CPU time
+    spent parsing, matching, and writing under 'timings', and the process ID and its
+    peak RSS in kilobytes under 'worker' and 'peak_rss_kb'
     """
-    try:
-        reads = fastq.read_fastq(fastq=filename, pair=reverse) # type: Tuple[fastq.Read]
-    except FileNotFoundError as error:
-        sys.exit("Cannot find " + error.filename)
-    output_directory = os.path.dirname(filename) # type: str
-    output_list = list() # type: List[Tuple[str, Optional[str]]]
-    basename = os.path.basename(filename)
-    for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
-        #   Create output names for forward and reverse files
-        # output_name = output_directory + '/' + sample_name + '_fwd.fastq' # type: str
-        output_name = output_directory + '/' + sample_name + '_fwd_' + basename # type: str
-        if reverse:
-            reverse_name = output_name.replace('fwd', 'rev') # type: str
-            rfile = open(reverse_name, 'w') # type: _io.TextIOWrapper
-        else:
-            reverse_name = None
-        output_list.append((output_name, reverse_name))
-        #   Zip the arguments together for the map
-        args = zip( # type: sip
-            reads,
-            itertools.repeat(barcode_list),
-            itertools.repeat(error_rate)
+    if reads is None:
+        for name in filter(None, (filename, reverse)): # type: str
+            if name != fastq.STDIN and not os.path.exists(name):
+                sys.exit("Cannot find " + name)
+        reads = fastq.iter_fastq( # type: Iterator[fastq.Read]
+            fastq=filename,
+            pair=reverse,
+            forward_range=forward_range,
+            reverse_range=reverse_range,
+            checksums=checksums
         )
-        #   Run the partitioning for each read for this barcode
-        results = map(lambda tup: match_barcode(*tup), args) # type: map
-        with open(output_name, 'w') as ofile: # type: _io.TextIOWrapper
-            for read in filter(None, results): # type: fastq.Read
-                ofile.write(read.fastq)
-                ofile.write('\n')
-                ofile.flush()
-                if reverse:
-                    rfile.write(read.reverse_fastq)
-                    rfile.write('\n')
-                    rfile.flush()
-        if reverse:
-            rfile.close()
-    return output_list
+    timer = instrument.StageTimer(per_thread=True) # type: instrument.StageTimer
+    classify_batch, placements = build_classifier( # type: Callable[[List[fastq.Read]], Iterable[Assignment]], Dict[str, List[Placement]]
+        barcodes=barcodes,
+        error_rate=error_rate,
+        offset=offset,
+        matcher=matcher,
+        layouts=layouts,
+        shift=shift,
+        dual_index=dual_index,
+        umis=extract_umis
+    )
+    output_directory = output_directory or os.path.dirname(os.path.abspath(filename)) # type: str
+    counts = new_counts(samples=barcodes) # type: Dict[str, Any]
+    window = barcode_window(barcodes=barcodes, offset=offset, placements=placements) # type: Callable[[fastq.Read], str]
+    basename = fastq.output_basename(filename=output_name or filename, compression=compression) # type: str
+    if prefix:
+        basename = prefix + '_' + basename
+    with fastq.WriterPool(compression=compression, max_buffered=max_buffered or fastq.MAX_BUFFERED) as pool: # type: fastq.WriterPool
+        outputs = dict() # type: Dict[str, Tuple[str, Optional[str]]]
+        for sample_name in itertools.chain(barcodes, (UNDETERMINED,)): # type: str
+            #   Create output names for forward and reverse files
+            sample_output = os.path.join(output_directory, sample_name + '_fwd_' + basename) # type: str
+            pool.add(sample_output)
+            if reverse:
+                sample_reverse = os.path.join(output_directory, sample_name + '_rev_' + basename) # type: Optional[str]
+                pool.add(sample_reverse)
+            else:
+                sample_reverse = None
+            outputs[sample_name] = (sample_output, sample_reverse)
+        #   Count a classified read and write it to the output of its sample
+        def write(read: fastq.Read, assignment: Assignment) -> None:
+            count_assignment(counts=counts, assignment=assignment)
+            if assignment.sample is None:
+                if not assignment.ambiguous:
+                    counts['unknown_barcodes'].add(window(read))
+                sample_output, sample_reverse = outputs[UNDETERMINED]
+            else:
+                sample_output, sample_reverse = outputs[assignment.sample]
+            pool.write(sample_output, read.fastq + '\n')
+            if reverse:
+                pool.write(sample_reverse, read.reverse_fastq + '\n')
+        #   Classify each read once and route it to its sample; batches are read and written in
+        #   their own threads, which wait on I/O and zlib without the GIL, while this one matches
+        stop = threading.Event() # type: threading.Event
+        errors = list() # type: List[BaseException]
+        batches = queue.Queue(maxsize=PIPELINE_DEPTH) # type: queue.Queue
+        matched = queue.Queue(maxsize=PIPELINE_DEPTH) # type: queue.Queue
+        threads = ( # type: Tuple[threading.Thread, ...]
+            threading.Thread(target=_profiled(_read_batches, profilers), args=(iter(reads), batches, timer, stop, errors), daemon=True),
+            threading.Thread(target=_profiled(_write_batches, profilers), args=(matched, write, timer, stop, errors), daemon=True)
+        )
+        try:
+            for thread in threads: # type: threading.Thread
+                thread.start()
+            while True:
+                batch = _get(pipe=batches, stop=stop) # type: Any
+                if batch is _END:
+                    break
+                with timer.stage('matching'):
+                    assignments = list(classify_batch(batch)) # type: List[Assignment]
+                if progress:
+                    progress(len(batch))
+                if not _put(pipe=matched, item=(batch, assignments), stop=stop):
+                    break
+            _put(pipe=matched, item=_END, stop=stop)
+            threads[1].join()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        with timer.stage('writing'):
+            pool.flush()
+    counts['outputs'] = outputs
+    counts['timings'] = timer.timings()
+    counts['worker'] = os.getpid()
+    counts['peak_rss_kb'] = instrument.peak_rss()
+    return counts
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""Compact summaries of what the workers saw"""
+
+import sys
+if sys.version_info.major is not 3 and sys.version_info.minor < 5:
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+import heapq
+from typing import Optional, Dict, List, Any
+
+
+class SpaceSaving(object):
+
+    """A Space-Saving sketch of the most frequent items in a stream
+    Tracks at most twice 'capacity' items. When the table fills up, only the 'capacity'
+    most frequent are kept, and every count dropped raises the 'floor': the most an
+    untracked item could have been seen. New items start from the floor, so counts
+    never underestimate, and overestimate by no more than their error. Sketches from
+    different workers can be merged
+    """
+
+    def __init__(self, capacity: int=1000) -> None:
+        """
+    capacity [int]=1000     The number of items to keep when the table fills up
+    """
+        if capacity < 1:
+            raise ValueError("'capacity' must be at least 1")
+        self._capacity = capacity # type: int
+        self._counts = dict() # type: Dict[str, int]
+        self._errors = dict() # type: Dict[str, int]
+        self._floor = 0 # type: int
+        self._total = 0 # type: int
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __contains__(self, item: str) -> bool:
+        return item in self._counts
+
+    def _get_total(self) -> int:
+        return self._total
+
+    def _get_floor(self) -> int:
+        return self._floor
+
+    def _prune(self) -> None:
+        if len(self._counts) <= self._capacity:
+            return
+        ranked = sorted(self._counts, key=self._counts.__getitem__, reverse=True) # type: List[str]
+        for item in ranked[self._capacity:]: # type: str
+            self._floor = max(self._floor, self._counts.pop(item))
+            del self._errors[item]
+
+    def add(self, item: str, count: int=1) -> None:
+        """Count an item
+        item [str]:     The item seen
+        count [int]=1   How many times it was seen
+        """
+        self._total += count
+        if item in self._counts:
+            self._counts[item] += count
+            return
+        self._counts[item] = self._floor + count
+        self._errors[item] = self._floor
+        if len(self._counts) >= 2 * self._capacity:
+            self._prune()
+
+    def merge(self, other: 'SpaceSaving') -> None:
+        """Add the counts from another sketch to this one
+        other [SpaceSaving]:    The sketch to merge in
+        """
+        for item in set(self._counts).difference(other._counts): # type: str
+            self._counts[item] += other._floor
+            self._errors[item] += other._floor
+        for item, count in other._counts.items(): # type: str, int
+            if item in self._counts:
+                self._counts[item] += count
+                self._errors[item] += other._errors[item]
+            else:
+                self._counts[item] = count + self._floor
+                self._errors[item] = other._errors[item] + self._floor
+        self._floor += other._floor
+        self._total += other._total
+        self._capacity = max(self._capacity, other._capacity)
+        self._prune()
+
+    def top(self, n: Optional[int]=None) -> List[Dict[str, Any]]:
+        """Get the most frequent items, most frequent first
+        n [int]=None    How many items to get, defaults to the sketch's capacity
+
+        Each item is a dictionary with the 'item', its estimated 'count', and the
+        'error', the most the count may be overestimated by
+        """
+        n = min(n or self._capacity, self._capacity) # type: int
+        ranked = heapq.nlargest(n, self._counts, key=self._counts.__getitem__) # type: List[str]
+        return [{'item': item, 'count': self._counts[item], 'error': self._errors[item]} for item in ranked]
+
+    def state(self) -> Dict[str, Any]:
+        """Get the sketch as plain values that can be written as JSON, see 'SpaceSaving.from_state'"""
+        return {
+            'capacity': self._capacity,
+            'counts': dict(self._counts),
+            'errors': dict(self._errors),
+            'floor': self._floor,
+            'total': self._total
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'SpaceSaving':
+        """Make a sketch from the values given by 'SpaceSaving.state'
+        state [Dict[str, Any]]:     The sketch's values
+        """
+        sketch = cls(capacity=state['capacity']) # type: SpaceSaving
+        sketch._counts = dict(state['counts'])
+        sketch._errors = dict(state['errors'])
+        sketch._floor = state['floor']
+        sketch._total = state['total']
+        return sketch
+
+    total = property(fget=_get_total, doc='Total count of every item added')
+    floor = property(fget=_get_floor, doc='Most times an untracked item could have been seen')
+
+
+#   Bases of a UMI in the order of their two-bit codes
+UMI_BASES = 'ACGT' # type: str
+_UMI_DIGITS = str.maketrans('ACGTacgt', '01230123') # type: Dict[int, int]
+
+
+def pack_umi(umi: str) -> Optional[int]:
+    """Pack a UMI into an integer, two bits per base behind a leading 1 bit that keeps its length
+    umi [str]:  The UMI to pack
+
+    Returns None for UMIs with bases other than A, C, G, and T
+    """
+    try:
+        return int('1' + umi.translate(_UMI_DIGITS), 4)
+    except ValueError:
+        return None
+
+
+def unpack_umi(code: int) -> str:
+    """Get the UMI back from 'pack_umi'
+    code [int]:     The packed UMI
+    """
+    bases = list() # type: List[str]
+    while code > 1:
+        bases.append(UMI_BASES[code & 3])
+        code >>= 2
+    return ''.join(reversed(bases))
+
+
+class UmiCounter(object):
+
+    """Counts of the UMIs seen in one sample, packed two bits per base by 'pack_umi'
+    Every UMI is counted exactly, keyed by its packed integer rather than its sequence.
+    UMIs with 'N's or other bases cannot be packed and are only counted as 'unpacked'.
+    Counters from different workers can be merged
+    """
+
+    def __init__(self) -> None:
+        self._counts = dict() # type: Dict[int, int]
+        self._unpacked = 0 # type: int
+        self._total = 0 # type: int
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __contains__(self, umi: str) -> bool:
+        return pack_umi(umi) in self._counts
+
+    def _get_total(self) -> int:
+        return self._total
+
+    def add(self, umi: str, count: int=1) -> None:
+        """Count a UMI
+        umi [str]:      The UMI seen
+        count [int]=1   How many times it was seen
+        """
+        self._total += count
+        code = pack_umi(umi) # type: Optional[int]
+        if code is None:
+            self._unpacked += count
+        else:
+            self._counts[code] = self._counts.get(code, 0) + count
+
+    def count(self, umi: str) -> int:
+        """How many times a UMI was seen
+        umi [str]:  The UMI to look up
+        """
+        return self._counts.get(pack_umi(umi), 0)
+
+    def merge(self, other: 'UmiCounter') -> None:
+        """Add the counts from another counter to this one
+        other [UmiCounter]:     The counter to merge in
+        """
+        for code, count in other._counts.items(): # type: int, int
+            self._counts[code] = self._counts.get(code, 0) + count
+        self._unpacked += other._unpacked
+        self._total += other._total
+
+    def summary(self) -> Dict[str, Any]:
+        """Get deduplication statistics: the 'reads' counted, the distinct 'umis', the 'singletons'
+        seen once, the 'duplication_rate' (the share of reads that repeat a UMI), the 'unpacked'
+        reads whose UMIs could not be packed, and 'family_sizes', how many UMIs were seen
+        each number of times
+        """
+        families = dict() # type: Dict[int, int]
+        for count in self._counts.values(): # type: int
+            families[count] = families.get(count, 0) + 1
+        packed = self._total - self._unpacked # type: int
+        return {
+            'reads': self._total,
+            'umis': len(self._counts),
+            'singletons': families.get(1, 0),
+            'duplication_rate': round(1 - len(self._counts) / packed, 6) if packed else 0.0,
+            'unpacked': self._unpacked,
+            'family_sizes': {str(size): families[size] for size in sorted(families)}
+        }
+
+    def state(self) -> Dict[str, Any]:
+        """Get the counter as plain values that can be written as JSON, see 'UmiCounter.from_state'"""
+        return {
+            'codes': list(self._counts.keys()),
+            'counts': list(self._counts.values()),
+            'unpacked': self._unpacked,
+            'total': self._total
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'UmiCounter':
+        """Make a counter from the values given by 'UmiCounter.state'
+        state [Dict[str, Any]]:     The counter's values
+        """
+        counter = cls() # type: UmiCounter
+        counter._counts = dict(zip(state['codes'], state['counts']))
+        counter._unpacked = state['unpacked']
+        counter._total = state['total']
+        return counter
+
+    total = property(fget=_get_total, doc='Total count of every UMI added')
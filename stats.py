@@ -8,33 +8,109 @@ if sys.version_info.major is not 3 and sys.version_info.minor < 5:
 
 
 import os
-from typing import Optional, List
+import json
+import itertools
+from typing import Iterable, List, Dict, Any
 
 try:
-    import numpy as np
-    import matplotlib.pyplot as plt
-except ImportError as error:
-    sys.exit("Please install " + error.name)
+    from sketch import SpaceSaving, UmiCounter
+    from instrument import StageTimer
+except ImportError:
+    sys.exit("Please leave this module in its directory to load the sketch and instrument modules")
 
 
-def stats_barc(output_files: List[str], output_directory: Optional[str]=None) -> None:
+REPORT_NAME = 'demux_report.json' # type: str
+PLOT_NAME = 'demultiplexedResults.pdf' # type: str
+#   How many of the most common unknown barcodes to list in the report
+TOP_UNKNOWN = 100 # type: int
+
+
+def merge_counts(counts: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Add together the counts returned by partition.partition for each chunk.
+    Totals, per-sample counts, per-sample mismatch histograms, index hops, and
+    stage timings are summed, the sketches of unknown barcodes and the UMI
+    counters of each sample are merged, and the peak RSS of
+    each worker process is kept under 'workers'; any other entries, such as
+    output filenames, are left out.
+    """
+    merged = {
+        'reads': 0,
+        'unassigned': 0,
+        'ambiguous': 0,
+        'assigned': dict(),
+        'mismatches': dict(),
+        'unknown_barcodes': SpaceSaving(),
+        'index_hopping': dict(),
+        'umis': dict(),
+        'workers': dict()
+    } # type: Dict[str, Any]
+    timer = StageTimer() # type: StageTimer
+    for chunk in counts: # type: Dict[str, Any]
+        for key in ('reads', 'unassigned', 'ambiguous'): # type: str
+            merged[key] += chunk[key]
+        for sample, count in chunk['assigned'].items(): # type: str, int
+            merged['assigned'][sample] = merged['assigned'].get(sample, 0) + count
+        for sample, histogram in chunk['mismatches'].items(): # type: str, List[int]
+            total = merged['mismatches'].get(sample, list()) # type: List[int]
+            merged['mismatches'][sample] = [sum(pair) for pair in itertools.zip_longest(total, histogram, fillvalue=0)]
+        merged['unknown_barcodes'].merge(chunk['unknown_barcodes'])
+        for forward, hops in chunk.get('index_hopping', dict()).items(): # type: str, Dict[str, int]
+            row = merged['index_hopping'].setdefault(forward, dict()) # type: Dict[str, int]
+            for reverse, count in hops.items(): # type: str, int
+                row[reverse] = row.get(reverse, 0) + count
+        for sample, umis in chunk.get('umis', dict()).items(): # type: str, UmiCounter
+            merged['umis'].setdefault(sample, UmiCounter()).merge(umis)
+        timer.add(chunk.get('timings', dict()))
+        if 'worker' in chunk:
+            worker = str(chunk['worker']) # type: str
+            merged['workers'][worker] = max(merged['workers'].get(worker, 0), chunk['peak_rss_kb'])
+    merged['timings'] = timer.timings()
+    return merged
+
+
+def write_report(report: Dict[str, Any], output_directory: str) -> str:
+    """
+    Write the demultiplexing report as JSON to 'demux_report.json' in the
+    output directory, and return the path to the report. Sketches of unknown
+    barcodes are written as their most common barcodes, and UMI counters as
+    their deduplication statistics.
+    """
+    report_file = os.path.join(output_directory, REPORT_NAME) # type: str
+    with open(report_file, 'w') as rfile:
+        json.dump(report, rfile, indent=2, sort_keys=True, default=_jsonable)
+        rfile.write('\n')
+    return report_file
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, SpaceSaving):
+        return [
+            {'barcode': entry['item'], 'count': entry['count'], 'error': entry['error']}
+            for entry in value.top(TOP_UNKNOWN)
+        ]
+    if isinstance(value, UmiCounter):
+        return value.summary()
+    raise TypeError("Cannot write %r to the report" % value)
+
+
+def stats_barc(report: Dict[str, Any], output_directory: str) -> str:
     """
     This function generates basic stats on demultiplexed datasets.
-    Currently, it takes all output files as argument in the form of a list, 
-    counts the number of fastq lines per file and
-    outputs a pdf file with a barplot of reads/demultiplexed dataset. The output directory 
-    for this pdf file is an optional argument with default set to the directory containing 
-    the fastq files.
+    It takes the report made from the workers' counts, and outputs a pdf file
+    with a barplot of reads/demultiplexed dataset, plus the unassigned and
+    ambiguous reads, to the output directory. Returns the path to the pdf file.
+    NumPy and matplotlib are only imported here, once the run is done.
     """
-    if not output_directory:
-        output_directory = os.path.dirname(output_files[0]) # type: str
-    file_names = tuple(os.path.basename(file) for file in output_files) # type: List[str]
-    output_size = [] # type: List[int]
-    for i in range(len(output_files)):
-        counts = sum(1 for line in open(output_files[i])) # type: int
-        output_size.append(counts)
-    divisor = 4 # type: int
-    outputs = (s / divisor for s in output_size) # type: generator
+    try:
+        import numpy as np
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError as error:
+        sys.exit("Please install " + error.name)
+    file_names = list(report['assigned'].keys()) + ['unassigned', 'ambiguous'] # type: List[str]
+    outputs = list(report['assigned'].values()) + [report['unassigned'], report['ambiguous']] # type: List[int]
     num_files = len(file_names) # type: int
     ind = np.arange(num_files)
     final_plot = plt.figure()
@@ -42,7 +118,7 @@ def stats_barc(output_files: List[str], output_directory: Optional[str]=None) ->
     plt.xticks(ind, file_names, rotation=45)
     plt.ylabel('number of reads')
     plt.title('dataset names')
-    plt.show()
-    if output_directory[-1] != '/':
-        output_directory += '/'
-    final_plot.savefig(output_directory + "demultiplexedResults.pdf", bbox_inches='tight')
+    plot_file = os.path.join(output_directory, PLOT_NAME) # type: str
+    final_plot.savefig(plot_file, bbox_inches='tight')
+    plt.close(final_plot)
+    return plot_file
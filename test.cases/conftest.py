@@ -0,0 +1,6 @@
+"""Lets the tests import BarcSeek's modules from the directory above, as its programs do"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""Generate synthetic FASTQ files, barcodes, and a sample sheet for testing BarcSeek
+
+A Python port of test.case.generator.R: each read is built from a barcode, a random
+degenerate sequence (UMI), a fixed extra sequence, and a random insert, with the
+barcode either on the left or right of the degenerate sequence
+"""
+
+import sys
+if sys.version_info.major is not 3 and sys.version_info.minor < 5:
+    sys.exit("Please use Python 3.5 or higher for this program")
+
+
+import os
+import gzip
+import bisect
+import random
+import argparse
+import itertools
+from typing import Tuple, List, Dict, Any
+
+
+BASES = 'ACGT' # type: str
+#   Quality characters used by the R generator: '!' and '#' through 'K'
+QUALITIES = '!' + ''.join(map(chr, range(35, 76))) # type: str
+EXTRAS = 'ACTG' # type: str
+#   Probabilities of 0, 1, 2, 3, and 4 errors in a barcode, from the R generator
+ERROR_PROBABILITIES = (0.9, 0.06, 0.025, 0.01, 0.005) # type: Tuple[float, ...]
+SCHEMES = ('left', 'right') # type: Tuple[str, ...]
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    """Make a random sequence of bases"""
+    return ''.join(rng.choice(BASES) for _ in range(length))
+
+
+def random_qualities(rng: random.Random, length: int) -> str:
+    """Make a random quality string"""
+    return ''.join(rng.choice(QUALITIES) for _ in range(length))
+
+
+def _distance(first: str, second: str) -> int:
+    return sum(a != b for a, b in zip(first, second))
+
+
+def make_barcodes(rng: random.Random, number: int, length: int=6, min_distance: int=3, attempts: int=100000) -> List[str]:
+    """Make random barcodes at least 'min_distance' substitutions apart
+    rng [random.Random]:    The random number generator
+    number [int]:           How many barcodes to make
+    length [int]=6          The length of each barcode
+    min_distance [int]=3    The smallest Hamming distance between any two barcodes
+    attempts [int]=100000   How many candidates to try before giving up
+    """
+    barcodes = list() # type: List[str]
+    for _ in range(attempts):
+        if len(barcodes) == number:
+            break
+        candidate = random_sequence(rng, length) # type: str
+        if all(_distance(candidate, barcode) >= min_distance for barcode in barcodes):
+            barcodes.append(candidate)
+    else:
+        if len(barcodes) < number:
+            raise ValueError("Cannot find %i barcodes of length %i at least %i apart" % (number, length, min_distance))
+    return barcodes
+
+
+def mutate_barcode(rng: random.Random, barcode: str, errors: int) -> str:
+    """Substitute 'errors' different positions of a barcode with other bases"""
+    bases = list(barcode) # type: List[str]
+    for position in rng.sample(range(len(bases)), min(errors, len(bases))): # type: int
+        bases[position] = rng.choice([base for base in BASES if base != bases[position]])
+    return ''.join(bases)
+
+
+def degenerate_length(rng: random.Random, length: int, variable: bool=False) -> int:
+    """The length of one degenerate sequence, binomially distributed around 'length' if 'variable'"""
+    if not variable:
+        return length
+    return sum(rng.random() < 0.5 for _ in range(2 * length))
+
+
+def _layout(scheme: str, barcode: str, degenerate: str, insert: str) -> str:
+    if scheme == 'left':
+        return barcode + degenerate + EXTRAS + insert
+    elif scheme == 'right':
+        return degenerate + barcode + EXTRAS + insert
+    raise ValueError("'scheme' must be one of " + ', '.join(SCHEMES))
+
+
+def _open(filename: str):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt')
+    return open(filename, 'w')
+
+
+def generate(
+        output_directory: str,
+        reads: int=100000,
+        samples: int=12,
+        scheme: str='left',
+        paired: bool=False,
+        dual: bool=False,
+        barcode_length: int=6,
+        min_distance: int=3,
+        umi_length: int=8,
+        variable_umi: bool=False,
+        insert_length: int=50,
+        error_probabilities: Tuple[float, ...]=ERROR_PROBABILITIES,
+        seed: int=2017,
+        name: str='test',
+        compress: bool=False
+) -> Dict[str, Any]:
+    """Write a synthetic test case: FASTQ files, a barcodes CSV, and a sample sheet
+    output_directory [str]:         Where to write the files
+    reads [int]=100000              How many reads, or read pairs, to write
+    samples [int]=12                How many samples to spread the reads evenly between
+    scheme [str]='left'             Where the barcode goes, one of SCHEMES: 'left' of the
+                                        degenerate sequence, or 'right' of it
+    paired [bool]=False             Write a reverse FASTQ file too
+    dual [bool]=False               Give each sample a second barcode in the reverse reads,
+                                        implies 'paired'
+    barcode_length [int]=6          The length of the barcodes
+    min_distance [int]=3            The smallest Hamming distance between any two barcodes
+    umi_length [int]=8              The length of the degenerate sequences
+    variable_umi [bool]=False       Vary the lengths of the degenerate sequences binomially
+                                        around 'umi_length', as the R generator does
+    insert_length [int]=50          The length of the random inserts
+    error_probabilities [Tuple[float, ...]]=ERROR_PROBABILITIES
+                                    The probabilities of 0, 1, 2, ... errors in a barcode
+    seed [int]=2017                 The random seed
+    name [str]='test'               The basename for the FASTQ files
+    compress [bool]=False           Gzip the FASTQ files
+
+    Returns a dictionary of the filenames written, under 'forward', 'reverse',
+    'barcodes', and 'sample_sheet', and the barcodes for each sample under 'samples'
+    """
+    paired = paired or dual
+    rng = random.Random(seed) # type: random.Random
+    barcodes = make_barcodes(rng, samples * (2 if dual else 1), barcode_length, min_distance) # type: List[str]
+    sample_barcodes = { # type: Dict[str, List[str]]
+        'sample_%i' % (index + 1): barcodes[index::samples] for index in range(samples)
+    }
+    os.makedirs(output_directory, exist_ok=True)
+    extension = '.fastq.gz' if compress else '.fastq' # type: str
+    files = {
+        'forward': os.path.join(output_directory, name + '.R1' + extension),
+        'reverse': os.path.join(output_directory, name + '.R2' + extension) if paired else None,
+        'barcodes': os.path.join(output_directory, 'barcodes.csv'),
+        'sample_sheet': os.path.join(output_directory, 'sample_sheet.tab'),
+        'samples': sample_barcodes
+    } # type: Dict[str, Any]
+    with open(files['barcodes'], 'w') as bfile:
+        for index, barcode in enumerate(barcodes): # type: int, str
+            bfile.write('%i,%s\n' % (index + 1, barcode))
+    with open(files['sample_sheet'], 'w') as sfile:
+        sfile.write('barcode1\tbarcode2\tsample_name\n')
+        for index, sample_name in enumerate(sample_barcodes): # type: int, str
+            second = str(index + samples + 1) if dual else '' # type: str
+            sfile.write('%i\t%s\t%s\n' % (index + 1, second, sample_name))
+    names = list(sample_barcodes) # type: List[str]
+    weights = list(itertools.accumulate(error_probabilities)) # type: List[float]
+    with _open(files['forward']) as forward, _open(files['reverse'] or os.devnull) as reverse:
+        for number in range(1, reads + 1): # type: int
+            sample_barcode = sample_barcodes[rng.choice(names)] # type: List[str]
+            read_name = 'test.%i:%s' % (number, '+'.join(sample_barcode)) # type: str
+            for index, handle in enumerate((forward, reverse) if paired else (forward,)): # type: int, Any
+                if index < len(sample_barcode):
+                    errors = bisect.bisect(weights, rng.random() * weights[-1]) # type: int
+                    barcode = mutate_barcode(rng, sample_barcode[index], errors) # type: str
+                    degenerate = random_sequence(rng, degenerate_length(rng, umi_length, variable_umi)) # type: str
+                    sequence = _layout(scheme, barcode, degenerate, random_sequence(rng, insert_length)) # type: str
+                else:
+                    sequence = random_sequence(rng, barcode_length + umi_length + len(EXTRAS) + insert_length)
+                handle.write('@%s %i:N:0\n%s\n+\n%s\n' % (read_name, index + 1, sequence, random_qualities(rng, len(sequence))))
+    return files
+
+
+#   A function to create an argument parser
+def _set_args():
+    parser = argparse.ArgumentParser( # type: argparse.ArgumentParser
+        description="Generate synthetic FASTQ files, barcodes, and a sample sheet for testing BarcSeek",
+        formatter_class=argparse.RawTextHelpFormatter,
+        add_help=True
+    )
+    parser.add_argument('-d', '--output-directory', dest='output_directory', type=str, default='.', metavar='DIRECTORY',
+                        help="Where to write the test case.\n[OPTIONAL, DEFAULT=.]")
+    parser.add_argument('-n', '--reads', dest='reads', type=int, default=100000, metavar='READS',
+                        help="How many reads, or read pairs, to write.\n[OPTIONAL, DEFAULT=100000]")
+    parser.add_argument('-s', '--samples', dest='samples', type=int, default=12, metavar='SAMPLES',
+                        help="How many samples to spread the reads between.\n[OPTIONAL, DEFAULT=12]")
+    parser.add_argument('-p', '--position', dest='scheme', type=str, default='left', choices=SCHEMES, metavar='POSITION',
+                        help="Put the barcode 'left' or 'right' of the degenerate sequence.\n[OPTIONAL, DEFAULT=left]")
+    parser.add_argument('-r', '--paired', dest='paired', action='store_true',
+                        help="Write reverse reads too.\n[OPTIONAL]")
+    parser.add_argument('-2', '--dual', dest='dual', action='store_true',
+                        help="Give each sample a second barcode in the reverse reads.\n[OPTIONAL]")
+    parser.add_argument('-b', '--barcode-length', dest='barcode_length', type=int, default=6, metavar='LENGTH',
+                        help="The length of the barcodes.\n[OPTIONAL, DEFAULT=6]")
+    parser.add_argument('-m', '--min-distance', dest='min_distance', type=int, default=3, metavar='DISTANCE',
+                        help="The smallest Hamming distance between any two barcodes.\n[OPTIONAL, DEFAULT=3]")
+    parser.add_argument('-u', '--umi-length', dest='umi_length', type=int, default=8, metavar='LENGTH',
+                        help="The length of the degenerate sequences.\n[OPTIONAL, DEFAULT=8]")
+    parser.add_argument('-v', '--variable-umi', dest='variable_umi', action='store_true',
+                        help="Vary the lengths of the degenerate sequences.\n[OPTIONAL]")
+    parser.add_argument('-i', '--insert-length', dest='insert_length', type=int, default=50, metavar='LENGTH',
+                        help="The length of the random inserts.\n[OPTIONAL, DEFAULT=50]")
+    parser.add_argument('-e', '--errors', dest='errors', type=str, default=','.join(map(str, ERROR_PROBABILITIES)),
+                        metavar='PROBABILITIES',
+                        help="Comma-separated probabilities of 0, 1, 2, ... errors in a barcode.\n[OPTIONAL, DEFAULT=%s]"
+                        % ','.join(map(str, ERROR_PROBABILITIES)))
+    parser.add_argument('--seed', dest='seed', type=int, default=2017, metavar='SEED',
+                        help="The random seed.\n[OPTIONAL, DEFAULT=2017]")
+    parser.add_argument('--name', dest='name', type=str, default='test', metavar='NAME',
+                        help="The basename for the FASTQ files.\n[OPTIONAL, DEFAULT=test]")
+    parser.add_argument('-z', '--gzip', dest='compress', action='store_true',
+                        help="Gzip the FASTQ files.\n[OPTIONAL]")
+    return parser
+
+
+def main(args: Dict[str, Any]) -> None:
+    '''Write a test case'''
+    files = generate(
+        output_directory=args['output_directory'],
+        reads=args['reads'],
+        samples=args['samples'],
+        scheme=args['scheme'],
+        paired=args['paired'],
+        dual=args['dual'],
+        barcode_length=args['barcode_length'],
+        min_distance=args['min_distance'],
+        umi_length=args['umi_length'],
+        variable_umi=args['variable_umi'],
+        insert_length=args['insert_length'],
+        error_probabilities=tuple(float(p) for p in args['errors'].split(',')),
+        seed=args['seed'],
+        name=args['name'],
+        compress=args['compress']
+    ) # type: Dict[str, Any]
+    for key in ('forward', 'reverse', 'barcodes', 'sample_sheet'): # type: str
+        if files[key]:
+            print(files[key])
+
+
+if __name__ == '__main__':
+    PARSER = _set_args() # type: argparse.ArgumentParser
+    ARGS = vars(PARSER.parse_args()) # type: Dict[str, Any]
+    main(ARGS)
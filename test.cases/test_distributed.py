@@ -0,0 +1,41 @@
+"""Partitioning on a dask.distributed LocalCluster gives the same output as local worker processes"""
+
+import os
+
+import pytest
+
+pytest.importorskip('distributed')
+
+import generator
+import parallel
+from BarcSeek import extract_barcodes
+
+
+def _run(files, output_dir, scheduler=None):
+    samples = extract_barcodes(files['sample_sheet'], files['barcodes'])
+    return parallel.parallelize(
+        sample_dict=samples,
+        num_lines=2000,
+        forward_fastq=files['forward'],
+        reverse_fastq=files['reverse'],
+        error_rate=1,
+        threads=2,
+        output_dir=output_dir,
+        scheduler=scheduler
+    )
+
+
+def test_local_cluster_matches_process_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = generator.generate(str(tmp_path / 'input'), reads=5000, samples=4, dual=True, barcode_length=8)
+    local = _run(files, str(tmp_path / 'local'))
+    cluster = _run(files, str(tmp_path / 'cluster'), scheduler='local')
+
+    assert cluster['chunks'] == local['chunks'] > 1
+    for key in ('reads', 'assigned', 'unassigned', 'ambiguous', 'mismatches'):
+        assert cluster[key] == local[key]
+    for sample, outputs in local['outputs'].items():
+        for local_file, cluster_file in zip(outputs, cluster['outputs'][sample]):
+            assert os.path.dirname(cluster_file) == str(tmp_path / 'cluster')
+            with open(local_file, 'rb') as lfile, open(cluster_file, 'rb') as cfile:
+                assert lfile.read() == cfile.read()
@@ -0,0 +1,59 @@
+"""The index, matrix, and regex matchers assign dual-barcoded reads, and report index hops, the same way"""
+
+import random
+
+import pytest
+
+import fastq
+import partition
+from BarcSeek import barcode_distance_check
+
+
+MATCHERS = {
+    'index': dict(offset=0),
+    'matrix': dict(offset=0, matcher='matrix'),
+    'regex': dict()
+}
+
+
+def _read(forward, reverse):
+    #   'N's after the barcodes keep the regex matcher from finding them anywhere else
+    tail = 'N' * 12
+    return fastq.Read('read', forward + tail, 'I' * (len(forward) + len(tail)), reverse + tail, 'I' * (len(reverse) + len(tail)))
+
+
+def _classify(barcodes, reads, matcher, **options):
+    partition._CLASSIFIERS.clear()
+    classify_batch, _ = partition.build_classifier(barcodes, error_rate=1, **dict(MATCHERS[matcher], **options))
+    return [(a.sample, a.errors, a.ambiguous, a.hopped) for a in classify_batch([_read(*read) for read in reads])]
+
+
+@pytest.mark.parametrize('barcodes, read, expected', [
+    ({'A': ['AAAAAA', 'CCCCCC'], 'B': ['AAAAAT', 'GGGGGG']}, ('AAAAAA', 'GGGGGG'), ('B', 1, False, None)),
+    ({'A': ['AAAAAA', 'CCCCCC'], 'B': ['AAAATT', 'GGGGGG']}, ('AAAAAT', 'GGGGGG'), ('B', 1, False, None)),
+    ({'A': ['AAAAAA', 'CCCCCC'], 'B': ['AAAAAT', 'GGGGGG']}, ('AAAAAA', 'CCCCCC'), ('A', 0, False, None)),
+    ({'A': ['AAAAAA', 'CCCCCC'], 'B': ['AAAAAT', 'CCCCCA']}, ('AAAAAA', 'CCCCCA'), (None, 1, True, None)),
+    ({'A': ['AAAAAA', 'CCCCCC'], 'B': ['GGGGGG', 'TTTTTT']}, ('AAAAAA', 'TTTTTT'), (None, None, False, None))
+])
+@pytest.mark.parametrize('dual_index', [False, True])
+def test_pairs_are_scored_by_total_errors(barcodes, read, expected, dual_index):
+    if dual_index and expected[0] is None and not expected[2]:
+        #   Unassigned reads with an exact match in each index are hops, only in dual-index mode
+        expected = (None, 0, False, read)
+    for matcher in MATCHERS:
+        assert _classify(barcodes, [read], matcher, dual_index=dual_index) == [expected], matcher
+
+
+@pytest.mark.parametrize('dual_index', [False, True])
+def test_index_and_matrix_agree(dual_index):
+    generator = random.Random(7)
+    mutate = lambda barcode: ''.join(generator.choice('ACGT') if generator.random() < 0.15 else base for base in barcode)
+    checked = 0
+    while checked < 10:
+        barcodes = {'sample_%i' % i: [''.join(generator.choice('ACGT') for _ in range(6)) for _ in range(2)] for i in range(6)}
+        if barcode_distance_check(barcodes, 1):
+            continue
+        checked += 1
+        pairs = list(barcodes.values())
+        reads = [(mutate(generator.choice(pairs)[0]), mutate(generator.choice(pairs)[1])) for _ in range(300)]
+        assert _classify(barcodes, reads, 'index', dual_index=dual_index) == _classify(barcodes, reads, 'matrix', dual_index=dual_index)
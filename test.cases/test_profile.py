@@ -0,0 +1,28 @@
+"""Profiling a run with -p records the manager, the workers, and every thread of their pipelines"""
+
+import os
+import pstats
+
+import generator
+import parallel
+from BarcSeek import extract_barcodes
+
+
+def test_profile_covers_pipeline_threads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = generator.generate(str(tmp_path / 'input'), reads=2000, samples=4, dual=True, barcode_length=8)
+    report = parallel.parallelize(
+        sample_dict=extract_barcodes(files['sample_sheet'], files['barcodes']),
+        num_lines=2000,
+        forward_fastq=files['forward'],
+        reverse_fastq=files['reverse'],
+        error_rate=1,
+        threads=2,
+        output_dir=str(tmp_path / 'output'),
+        profile=True
+    )
+
+    assert report['assigned'] and os.path.exists(report['profile'])
+    functions = {function for (filename, line, function) in pstats.Stats(str(tmp_path / 'output' / 'profile.prof')).stats}
+    # the manager, the matching thread of each worker, and its reading and writing threads
+    assert {'_fetch_chunk_files_', 'partition', 'classify', '_read_batches', '_write_batches'} <= functions